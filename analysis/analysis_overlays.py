@@ -37,6 +37,10 @@ plt.rcParams['svg.fonttype'] = 'none'  # to embed fonts in output ('path' is to
 plt.rcParams["font.family"] = "sans-serif"
 plt.rcParams['axes.linewidth']=0.5
 
+# attributes of the cells used by the overlays, the only columns read from a columnar collection
+COLLECTION_COLUMNS = ['height', 'width', 'area', 'volume', 'height_um', 'width_um', 'area_um2', 'volume_um3', \
+        'fluorescence.total', 'fluorescence.background_px']
+
 #################### function ####################
 def default_parameters():
     """Generate a default parameter dictionary."""
@@ -779,7 +783,7 @@ def hist_queen_old(celldicts, labels, outputdir='.', bins=['auto','auto','auto']
 #################### main ####################
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="Analysis tool -- Overlay of several data sets.")
-    parser.add_argument('cellfiles',  type=str, nargs='+', help='Path to a cell dictionary in json format.')
+    parser.add_argument('cellfiles',  type=str, nargs='+', help='Path to cell collections (dictionaries in json format or columns directories).')
     parser.add_argument('-f', '--paramfile',  type=file, required=False, help='Yaml file containing parameters.')
     parser.add_argument('-d', '--outputdir',  type=str, required=False, help='Output directory')
     parser.add_argument('--labels',  type=str, nargs='+', required=False, help='Add labels')
@@ -792,7 +796,7 @@ if __name__ == "__main__":
     cellfiles = []
     for f in namespace.cellfiles:
         cellfile = os.path.realpath(f)
-        if not os.path.isfile(cellfile):
+        if not os.path.exists(cellfile):
             raise ValueError("Cell file does not exist! {:<s}".format(cellfile))
         cellfiles.append(cellfile)
 
@@ -801,7 +805,7 @@ if __name__ == "__main__":
     for n in range(nfiles):
         cellfile = cellfiles[n]
         print cellfile
-        cells = load_json2dict(cellfile)
+        cells = load_collection(cellfile, columns=COLLECTION_COLUMNS)
         ncells = len(cells)
         print "ncells = {:d}".format(ncells)
         celldicts.append(cells)
@@ -35,6 +35,9 @@ plt.rcParams['svg.fonttype'] = 'none'  # to embed fonts in output ('path' is to
 plt.rcParams["font.family"] = "sans-serif"
 plt.rcParams['axes.linewidth']=0.5
 
+# attributes of the cells used by the analysis, the only columns read from a columnar collection
+COLLECTION_COLUMNS = ['fluorescence']
+
 #################### function ####################
 def default_parameters():
     """Generate a default parameter dictionary."""
@@ -151,7 +154,7 @@ def make_plot_queen(cells, outputdir='.', bins=['auto','auto','auto'], titles=['
 #################### main ####################
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="Analysis tool -- QUEEN indicator.")
-    parser.add_argument('cellfile',  type=str, help='Path to a cell dictionary in json format.')
+    parser.add_argument('cellfile',  type=str, help='Path to a cell collection (dictionary in json format or columns directory).')
     parser.add_argument('-f', '--paramfile',  type=file, required=False, help='Yaml file containing parameters.')
     parser.add_argument('-d', '--outputdir',  type=str, required=False, help='Output directory')
     parser.add_argument('--debug',  action='store_true', required=False, help='Enable debug mode')
@@ -162,10 +165,10 @@ if __name__ == "__main__":
 
     # input cell file
     cellfile = os.path.realpath(namespace.cellfile)
-    if not os.path.isfile(cellfile):
+    if not os.path.exists(cellfile):
         raise ValueError("Cell file does not exist! {:<s}".format(cellfile))
 
-    cells = load_json2dict(cellfile)
+    cells = load_collection(cellfile, columns=COLLECTION_COLUMNS)
     ncells = len(cells)
     print "ncells = {:d}".format(ncells)
 
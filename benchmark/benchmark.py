@@ -0,0 +1,267 @@
+#################### imports ####################
+# standard
+import sys
+import os
+import numpy as np
+import yaml
+import argparse
+import shutil
+import subprocess
+import glob
+import time
+
+# custom
+CODEDIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'image_processing')
+sys.path.insert(0, CODEDIR)
+from utils import *
+from synthetic_data import make_dataset, get_ground_truth_file, load_ground_truth
+
+#################### global params ####################
+STAGES = ['preprocess', 'estimator', 'mask', 'label', 'collection']
+
+#################### function ####################
+def get_stage_dirs(workdir):
+    """
+    Return the directories of the benchmark: synthetic images, preprocessed images and segmentation.
+    """
+    datadir = os.path.join(workdir, 'TIFFS')
+    predir = os.path.join(workdir, 'TIFFS_preprocessed')
+    segdir = os.path.join(workdir, 'cells', 'segmentation')
+    return datadir, predir, segdir
+
+def run_stage(stage, workdir, allparams, njobs=1):
+    """
+    Run one stage of the image processing pipeline on the images of the benchmark, in the same layout as the
+    pipeline scripts.
+    INPUT:
+      * stage: one of 'preprocess', 'estimator', 'mask' or 'label'. The collection is run with collection_cells.py.
+      * workdir: working directory of the benchmark.
+    OUTPUT:
+      * number of FOVs processed.
+    """
+    from preprocess_images import preprocess_image, estimate_flatfield, write_flatfield, MEMFACTOR as PREPROCESS_MEMFACTOR
+    from segmentation_cells import get_estimator, get_mask, get_label, MEMFACTOR
+    datadir, predir, segdir = get_stage_dirs(workdir)
+
+    if stage == 'preprocess':
+        params = allparams['preprocess_images']
+        tiff_files = sorted(glob.glob(os.path.join(datadir, '*.tif')))
+        if not os.path.isdir(predir):
+            os.makedirs(predir)
+        for metadata in ['metadata.txt', 'fovs.txt']:
+            shutil.copy(os.path.join(datadir, metadata), os.path.join(predir, metadata))
+        mem_per_job = PREPROCESS_MEMFACTOR*get_tiff_nbytes(tiff_files[0])
+        if (params.get('bg_method', None) == 'flatfield') and (params.get('flatfield', {}).get('file', None) is None):
+            # flat-field of the experiment, estimated once
+            ffparams = dict(params['flatfield'])
+            ffparams.pop('file', None)
+            profile = estimate_flatfield(tiff_files, invert=params.get('invert', None), njobs=njobs, **ffparams)
+            write_flatfield(os.path.join(predir, 'flatfield.npz'), profile)
+        jobs = [([f], dict(outputdir=predir, **params)) for f in tiff_files]
+        run_jobs(preprocess_image, jobs, njobs=njobs, mem_per_job=mem_per_job)
+        return len(tiff_files)
+
+    params = allparams['segmentation']
+    method = params['method']
+    file_format = params.get('file_format', 'compact')
+    pathtoindex = os.path.join(segdir, 'index_tiffs.txt')
+    if stage == 'estimator':
+        tiff_files = sorted(glob.glob(os.path.join(predir, '*.tif')))
+        outputdir = os.path.join(segdir, 'estimators')
+        if not os.path.isdir(outputdir):
+            os.makedirs(outputdir)
+        for metadata in ['metadata.txt', 'fovs.txt']:
+            shutil.copy(os.path.join(predir, metadata), os.path.join(workdir, metadata))
+        kwargs = dict(method=method, outputdir=outputdir, estimator_params=params['estimator_params'][method], channel=params['channel'], file_format=file_format)
+        jobs = [([f], kwargs) for f in tiff_files]
+        func = get_estimator
+        index = [[os.path.relpath(f, segdir)] for f in tiff_files]
+    else:
+        index = [list(row) for row in load_index(pathtoindex)]
+        tiff_files = [os.path.join(segdir, row[0]) for row in index]
+        if stage == 'mask':
+            index = [row[:2] for row in index]
+            outputdir = os.path.join(segdir, 'masks')
+            jobs = [([os.path.join(segdir, f), os.path.join(segdir, ef)], dict(outputdir=outputdir, file_format=file_format, **params['mask_params'])) for f, ef in index]
+            func = get_mask
+        elif stage == 'label':
+            index = [row[:3] for row in index]
+            outputdir = os.path.join(segdir, 'labels')
+            jobs = [([os.path.join(segdir, f), os.path.join(segdir, mf)], dict(ef=os.path.join(segdir, ef), threshold=params['mask_params']['threshold'], outputdir=outputdir, file_format=file_format)) for f, ef, mf in index]
+            func = get_label
+        else:
+            raise ValueError("Stage not implemented: {}".format(stage))
+        if not os.path.isdir(outputdir):
+            os.makedirs(outputdir)
+
+    mem_per_job = MEMFACTOR*get_tiff_nbytes(tiff_files[0])
+    results = run_jobs(func, jobs, njobs=njobs, mem_per_job=mem_per_job)
+    for row, res in zip(index, results):
+        row.append(os.path.relpath(res, segdir))
+    write_index(pathtoindex, np.array(index, dtype=np.string_))
+
+    return len(tiff_files)
+
+def time_stage(cmd, logfile, cwd=None):
+    """
+    Run a command in a child process and measure it.
+    OUTPUT:
+      * wall time in seconds, peak resident memory in MB of the child process (or of its largest worker), and
+        return code of the child process.
+    """
+    with open(logfile, 'w') as fout:
+        t0 = time.time()
+        proc = subprocess.Popen(cmd, stdout=fout, stderr=subprocess.STDOUT, cwd=cwd)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        walltime = time.time() - t0
+    proc.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status))
+    # ru_maxrss is in kB on Linux
+    peak_rss = rusage.ru_maxrss / 1024.
+
+    return walltime, peak_rss, proc.returncode
+
+def match_labels(gt_labels, labels, iou_min=0.5):
+    """
+    Match the objects of a label matrix to the ground truth by their intersection over union (IoU).
+    With iou_min >= 0.5, an object can match at most one ground truth object.
+    OUTPUT:
+      * dictionary with the number of ground truth objects (ngt), objects (npred), matches (ntp), and for each
+        match the IoU and the areas of the ground truth and of the object.
+    """
+    ngt = int(np.max(gt_labels))
+    npred = int(np.max(labels))
+    gt = np.ravel(gt_labels).astype(np.int_)
+    pred = np.ravel(labels).astype(np.int_)
+    inter = np.bincount(gt*(npred+1) + pred, minlength=(ngt+1)*(npred+1)).reshape((ngt+1, npred+1))
+    area_gt = np.sum(inter, axis=1)
+    area_pred = np.sum(inter, axis=0)
+    inter = inter[1:,1:]
+    union = area_gt[1:,None] + area_pred[None,1:] - inter
+    iou = inter / np.maximum(union, 1).astype(np.float_)
+    igt, ipred = np.nonzero(iou > iou_min)
+
+    res = {}
+    res['ngt'] = ngt
+    res['npred'] = len(np.flatnonzero(area_pred[1:]))
+    res['ntp'] = len(igt)
+    res['iou'] = iou[igt, ipred]
+    res['area_gt'] = area_gt[1:][igt]
+    res['area_pred'] = area_pred[1:][ipred]
+
+    return res
+
+def get_accuracy(workdir, iou_min=0.5):
+    """
+    Compare the labels of the segmentation to the ground truth of the synthetic images.
+    OUTPUT:
+      * dictionary with the precision, recall and F1 score of the detection, the mean IoU of the matched cells and
+        the median relative error on their area.
+    """
+    datadir, predir, segdir = get_stage_dirs(workdir)
+    index = load_index(os.path.join(segdir, 'index_tiffs.txt'))
+    ngt = 0
+    npred = 0
+    ntp = 0
+    iou = []
+    area_err = []
+    for row in index:
+        f = row[0]
+        lf = row[-1]
+        gt_labels, cells = load_ground_truth(get_ground_truth_file(os.path.join(datadir, os.path.basename(f))))
+        labels = load_labels(os.path.join(segdir, lf))
+        res = match_labels(gt_labels, labels, iou_min=iou_min)
+        ngt += res['ngt']
+        npred += res['npred']
+        ntp += res['ntp']
+        iou.append(res['iou'])
+        area_err.append(np.abs(res['area_pred'] - res['area_gt']) / res['area_gt'].astype(np.float_))
+    iou = np.concatenate(iou)
+    area_err = np.concatenate(area_err)
+
+    acc = {}
+    acc['ncells_gt'] = ngt
+    acc['ncells_segmented'] = npred
+    acc['ncells_matched'] = ntp
+    acc['precision'] = (float(ntp) / npred if npred > 0 else 0.)
+    acc['recall'] = (float(ntp) / ngt if ngt > 0 else 0.)
+    acc['f1'] = (2.*ntp / (ngt + npred) if (ngt + npred) > 0 else 0.)
+    acc['iou_mean'] = (float(np.mean(iou)) if len(iou) > 0 else 0.)
+    acc['area_error_median'] = (float(np.median(area_err)) if len(area_err) > 0 else 0.)
+
+    return acc
+
+#################### main ####################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Benchmark of the image processing pipeline on synthetic images.")
+    parser.add_argument('-f', '--paramfile',  type=file, required=False, help='Yaml file containing parameters.')
+    parser.add_argument('-d', '--outputdir',  type=str, required=True, help='Working directory of the benchmark.')
+    parser.add_argument('-j', '--jobs',  type=int, required=False, default=1, help='Number of worker processes (0 for as many as CPUs, capped by the available memory).')
+    parser.add_argument('--stages',  type=str, nargs='+', required=False, default=STAGES, choices=STAGES, help='Stages to benchmark.')
+    parser.add_argument('--keep',  action='store_true', required=False, help='Reuse the synthetic images of the working directory.')
+    parser.add_argument('--run-stage',  type=str, required=False, help=argparse.SUPPRESS)
+
+    # INITIALIZATION
+    namespace = parser.parse_args(sys.argv[1:])
+    workdir = os.path.realpath(namespace.outputdir)
+    if namespace.paramfile is None:
+        paramfile = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'params.yaml')
+    else:
+        paramfile = os.path.realpath(namespace.paramfile.name)
+    with open(paramfile, 'r') as fin:
+        allparams = yaml.load(fin)
+
+    # single stage in a child process
+    if not (namespace.run_stage is None):
+        nfovs = run_stage(namespace.run_stage, workdir, allparams, njobs=namespace.jobs)
+        print "{:<20s}{:<d}".format("nfovs", nfovs)
+        sys.exit(0)
+
+    params = allparams['benchmark']
+    datadir, predir, segdir = get_stage_dirs(workdir)
+    print "{:<20s}{:<s}".format("outputdir", workdir)
+
+    # SYNTHETIC IMAGES
+    if not (namespace.keep and os.path.isdir(datadir)):
+        if os.path.isdir(datadir):
+            shutil.rmtree(datadir)
+        height, width = params['size']
+        make_dataset(datadir, nfovs=params['nfovs'], seed=params['seed'], height=height, width=width, nchannels=params['nchannels'], density=params['density'])
+    nfovs = len(glob.glob(os.path.join(datadir, '*.tif')))
+    # outputs of the stages to run
+    for stage, d in zip(['preprocess', 'estimator', 'collection'], [predir, segdir, os.path.join(workdir, 'cells', 'collection')]):
+        if (stage in namespace.stages) and os.path.isdir(d):
+            shutil.rmtree(d)
+    logdir = os.path.join(workdir, 'logs')
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+
+    # STAGES
+    # each stage runs in its own process, so that its peak memory is measured separately
+    report = {'nfovs': nfovs, 'jobs': namespace.jobs, 'paramfile': paramfile, 'stages': {}}
+    print "{:<12s}{:>10s}{:>10s}{:>12s}".format("stage", "time (s)", "FOVs/s", "peak RSS MB")
+    for stage in STAGES:
+        if not (stage in namespace.stages):
+            continue
+        if stage == 'collection':
+            cmd = [sys.executable, os.path.join(CODEDIR, 'collection_cells.py'), '-f', paramfile, '-d', '.']
+        else:
+            cmd = [sys.executable, os.path.realpath(__file__), '-f', paramfile, '-d', workdir, '-j', str(namespace.jobs), '--run-stage', stage]
+        logfile = os.path.join(logdir, stage+'.log')
+        walltime, peak_rss, returncode = time_stage(cmd, logfile, cwd=workdir)
+        if returncode != 0:
+            raise ValueError("Stage {} failed, see {}".format(stage, logfile))
+        report['stages'][stage] = {'time_s': walltime, 'fovs_per_s': nfovs / walltime, 'peak_rss_mb': peak_rss}
+        print "{:<12s}{:>10.2f}{:>10.2f}{:>12.1f}".format(stage, walltime, nfovs / walltime, peak_rss)
+
+    # ACCURACY
+    if os.path.isfile(os.path.join(segdir, 'index_tiffs.txt')) and ('label' in namespace.stages):
+        acc = get_accuracy(workdir, iou_min=params['iou_min'])
+        report['accuracy'] = acc
+        for key in ['ncells_gt', 'ncells_segmented', 'ncells_matched']:
+            print "{:<20s}{:<d}".format(key, acc[key])
+        for key in ['precision', 'recall', 'f1', 'iou_mean', 'area_error_median']:
+            print "{:<20s}{:<.4f}".format(key, acc[key])
+
+    fileout = os.path.join(workdir, 'benchmark.txt')
+    write_dict2json(fileout, report)
+    print "{:<20s}{:<s}".format("fileout", fileout)
@@ -0,0 +1,262 @@
+#################### imports ####################
+# standard
+import sys
+import os
+import numpy as np
+import argparse
+import cv2
+
+# custom
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'image_processing'))
+from utils import write_tiff, write_dict2json, write_fov_table
+
+#################### function ####################
+def get_capsule_mask(shape, xcenter, ycenter, length, width, angle):
+    """
+    Return the binary mask of a rod-shaped cell (rectangle with two hemispherical caps).
+    INPUT:
+      * shape: (height, width) of the image.
+      * xcenter, ycenter: position of the center of the cell in px.
+      * length, width: total length (caps included) and width of the cell in px.
+      * angle: orientation of the long axis in degrees, counter-clockwise from the x-axis.
+    OUTPUT:
+      * mask: boolean matrix restricted to the bounding slice of the cell.
+      * sl: bounding slice (slice_y, slice_x) of the cell.
+    """
+    height, img_width = shape
+    r = 0.5*width
+    a = np.deg2rad(angle)
+    dx = 0.5*(length-width)*np.cos(a)
+    dy = -0.5*(length-width)*np.sin(a)
+    x0 = max(int(np.floor(xcenter-abs(dx)-r)), 0)
+    x1 = min(int(np.ceil(xcenter+abs(dx)+r))+1, img_width)
+    y0 = max(int(np.floor(ycenter-abs(dy)-r)), 0)
+    y1 = min(int(np.ceil(ycenter+abs(dy)+r))+1, height)
+    sl = (slice(y0,y1), slice(x0,x1))
+    Y, X = np.mgrid[y0:y1, x0:x1]
+
+    # distance to the central segment of the cell
+    px = X - (xcenter - dx)
+    py = Y - (ycenter - dy)
+    seg2 = 4.*(dx**2 + dy**2)
+    if seg2 > 0.:
+        u = np.clip((px*2*dx + py*2*dy) / seg2, 0., 1.)
+    else:
+        u = np.zeros(px.shape)
+    d2 = (px - 2*dx*u)**2 + (py - 2*dy*u)**2
+    mask = (d2 <= r**2)
+
+    return mask, sl
+
+def get_background(shape, level=1000., gradient=0.3, bump=0.5, rng=None):
+    """
+    Return an uneven background: a linear gradient across the FOV and a broad Gaussian illumination spot at a
+    random position, normalized so that the mean is close to level.
+    """
+    if rng is None:
+        rng = np.random
+    height, width = shape
+    Y, X = np.mgrid[0:height, 0:width]
+    X = X / float(width)
+    Y = Y / float(height)
+    theta = rng.uniform(0., 2*np.pi)
+    bg = 1. + gradient*((X-0.5)*np.cos(theta) + (Y-0.5)*np.sin(theta))
+    x0, y0 = rng.uniform(0.2, 0.8, size=2)
+    bg += bump*np.exp(-((X-x0)**2 + (Y-y0)**2) / (2*0.35**2))
+    bg *= level / np.mean(bg)
+
+    return bg
+
+def make_fov(height=1024, width=1024, nchannels=3, density=0.1, length=(25.,60.), cell_width=(8.,12.), phase=True, background=1000., brightness=3000., psf=1.0, gap=3, border=10, illumination=None, rng=None):
+    """
+    Generate a synthetic agar-pad FOV with rod-shaped cells of known geometry.
+    INPUT:
+      * height, width: size of the FOV in px.
+      * nchannels: number of channels. If phase is True, channel 0 imitates phase contrast (dark cells on a
+        bright background) and the other channels are fluorescence channels (bright cells).
+      * density: fraction of the FOV area covered by cells.
+      * length, cell_width: ranges of the cell lengths and widths in px (uniform distributions).
+      * background, brightness: mean background level and median cell intensity above the background.
+      * psf: standard deviation in px of the Gaussian blur applied to the cells.
+      * gap: minimum distance in px between two cells.
+      * border: minimum distance in px between the cells and the edges of the FOV.
+      * illumination: (nchannels, height, width) illumination profiles with a mean of 1, shared by the FOVs of an
+        experiment. The level of each FOV varies by a few percent. If None, a profile is drawn for the FOV.
+    OUTPUT:
+      * img: uint16 image with shape (nchannels, height, width).
+      * labels: int32 ground truth label matrix (0 is the background, cell n has label n).
+      * cells: dictionary of ground truth arrays, one entry per cell: id, xcenter, ycenter, length, width, angle,
+        area (in px), and fluorescence (ncells, nchannels), the total intensity of the cell above the background.
+    """
+    if rng is None:
+        rng = np.random
+    shape = (height, width)
+    labels = np.zeros(shape, dtype=np.int32)
+
+    # place cells without overlap
+    mean_area = np.mean(cell_width)*np.mean(length) - (1.-np.pi/4.)*np.mean(cell_width)**2
+    ncells_target = int(density*height*width / mean_area)
+    keys = ['id', 'xcenter', 'ycenter', 'length', 'width', 'angle', 'area']
+    cells = {key: [] for key in keys}
+    ntrials = 20*ncells_target
+    n = 0
+    for trial in range(ntrials):
+        if n >= ncells_target:
+            break
+        L = rng.uniform(*length)
+        w = rng.uniform(*cell_width)
+        a = rng.uniform(0., 180.)
+        pad = 0.5*L + border
+        if (2*pad >= width) or (2*pad >= height):
+            continue
+        xc = rng.uniform(pad, width-pad)
+        yc = rng.uniform(pad, height-pad)
+        # check the neighbourhood of the cell
+        mask_gap, sl_gap = get_capsule_mask(shape, xc, yc, L+2*gap, w+2*gap, a)
+        if np.any(labels[sl_gap][mask_gap] > 0):
+            continue
+        mask, sl = get_capsule_mask(shape, xc, yc, L, w, a)
+        area = np.sum(mask)
+        if area == 0:
+            continue
+        n += 1
+        labels[sl][mask] = n
+        for key, val in zip(keys, [n, xc, yc, L, w, a, area]):
+            cells[key].append(val)
+    for key in keys:
+        cells[key] = np.array(cells[key])
+    cells['id'] = np.array(cells['id'], dtype=np.int_)
+    cells['area'] = np.array(cells['area'], dtype=np.int_)
+    ncells = n
+
+    # intensity of the cells in each channel
+    nfluo = nchannels - (1 if phase else 0)
+    cell_levels = brightness*rng.lognormal(0., 0.3, size=(ncells+1, max(nfluo,1)))
+    cell_levels[0] = 0.
+    cells['fluorescence'] = np.zeros((ncells, nchannels), dtype=np.float_)
+
+    img = np.zeros((nchannels, height, width), dtype=np.float_)
+    cellmask = np.array(labels > 0, dtype=np.float_)
+    if psf > 0.:
+        cellmask_blur = cv2.GaussianBlur(cellmask, (0,0), sigmaX=psf)
+    else:
+        cellmask_blur = cellmask
+    for c in range(nchannels):
+        if illumination is None:
+            bg = get_background(shape, level=background*(1.+0.5*c), rng=rng)
+        else:
+            bg = background*(1.+0.5*c)*rng.uniform(0.95, 1.05)*illumination[c]
+        if phase and (c == 0):
+            # phase contrast: cells absorb light
+            img[c] = 2.*bg*(1. - 0.6*cellmask_blur)
+        else:
+            k = c - (1 if phase else 0)
+            signal = cell_levels[labels, k]
+            if psf > 0.:
+                signal = cv2.GaussianBlur(signal, (0,0), sigmaX=psf)
+            img[c] = bg + signal
+            cells['fluorescence'][:,c] = np.bincount(np.ravel(labels), weights=np.ravel(cell_levels[labels, k]), minlength=ncells+1)[1:]
+
+    # shot noise
+    img = rng.normal(img, np.sqrt(np.maximum(img, 1.)))
+    img = np.array(np.clip(np.rint(img), 0, 2**16-1), dtype=np.uint16)
+
+    return img, labels, cells
+
+def get_ground_truth_file(tiff_file):
+    """
+    Return the path of the ground truth of a synthetic image: <dir>/ground_truth/<name>.npz
+    """
+    dirname = os.path.dirname(tiff_file)
+    bname = os.path.splitext(os.path.basename(tiff_file))[0]
+    return os.path.join(dirname, 'ground_truth', bname+'.npz')
+
+def write_ground_truth(fileout, labels, cells):
+    """
+    Write the ground truth labels and cell table of a synthetic image.
+    """
+    dirname = os.path.dirname(fileout)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    np.savez_compressed(fileout, labels=labels, **cells)
+    return
+
+def load_ground_truth(pathtogt):
+    """
+    Load the ground truth written by write_ground_truth.
+    OUTPUT:
+      * labels: ground truth label matrix.
+      * cells: dictionary of ground truth arrays (see make_fov).
+    """
+    with np.load(pathtogt) as data:
+        cells = {key: data[key] for key in data.files}
+    labels = cells.pop('labels')
+    return labels, cells
+
+def make_dataset(outputdir, nfovs=8, name='synthetic', mpp=0.11, seed=0, tiff_options=None, **kwargs):
+    """
+    Write a synthetic experiment in outputdir, laid out as the output of process_nd2.py:
+      * one ImageJ TIFF stack per FOV (<name>_f<fov>.tif) with the FOV index ('m') and pixel size ('mpp') in
+        the metadata.
+      * metadata.txt and the table of FOVs fovs.txt.
+      * the ground truth of each FOV in ground_truth/<name>_f<fov>.npz.
+    The illumination profile is drawn once and shared by all the FOVs, unless given in the keyword arguments.
+    The remaining keyword arguments are passed to make_fov.
+    OUTPUT:
+      * list of the tiff files written.
+    """
+    if not os.path.isdir(outputdir):
+        os.makedirs(outputdir)
+    rng = np.random.RandomState(seed)
+
+    # illumination of the microscope, the same for all FOVs
+    if not ('illumination' in kwargs):
+        shape = (kwargs.get('height', 1024), kwargs.get('width', 1024))
+        kwargs['illumination'] = np.array([get_background(shape, level=1., rng=rng) for c in range(kwargs.get('nchannels', 3))])
+
+    fmt = "{{:s}}_f{{:0{:d}d}}".format(len(str(nfovs-1)))
+    records = []
+    tiff_files = []
+    ncells = 0
+    for fov in range(nfovs):
+        img, labels, cells = make_fov(rng=rng, **kwargs)
+        nchannels, height, width = img.shape
+        bname = fmt.format(name, fov)
+        fileout = os.path.join(outputdir, bname+'.tif')
+        write_tiff(fileout, img, metadata={'m': fov, 'mpp': mpp}, tiff_options=tiff_options)
+        write_ground_truth(get_ground_truth_file(fileout), labels, cells)
+        print "{:<20s}{:<s}".format('fileout', fileout)
+        tiff_files.append(fileout)
+        ncells += len(cells['id'])
+
+        # FOVs on a square grid of the stage
+        ncols = int(np.ceil(np.sqrt(nfovs)))
+        record = {'fov': fov, 't': -1, 'file': os.path.basename(fileout), 'shape': list(img.shape), 'mpp': mpp, \
+                'x_um': (fov % ncols)*width*mpp, 'y_um': (fov // ncols)*height*mpp, 'z_um': None, 't_ms': None}
+        records.append(record)
+
+    metadata = {'sequence_count': nfovs, 'tile_height': height, 'tile_width': width, 'mpp': mpp, 'synthetic': True, 'seed': seed}
+    pathtometa = os.path.join(outputdir, 'metadata.txt')
+    write_dict2json(pathtometa, metadata)
+    print "{:<20s}{:<s}".format('fileout', pathtometa)
+    pathtotable = os.path.join(outputdir, 'fovs.txt')
+    write_fov_table(pathtotable, records)
+    print "{:<20s}{:<s}".format('fileout', pathtotable)
+    print "{:<20s}{:<d}".format('ncells', ncells)
+
+    return tiff_files
+
+#################### main ####################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Synthetic agar-pad images.")
+    parser.add_argument('-d', '--outputdir',  type=str, required=True, help='Output directory')
+    parser.add_argument('-n', '--nfovs',  type=int, required=False, default=8, help='Number of FOVs.')
+    parser.add_argument('--size',  type=int, nargs=2, required=False, default=[1024,1024], help='Height and width of the FOVs in px.')
+    parser.add_argument('--nchannels',  type=int, required=False, default=3, help='Number of channels (channel 0 is phase contrast).')
+    parser.add_argument('--density',  type=float, required=False, default=0.1, help='Fraction of the FOV area covered by cells.')
+    parser.add_argument('--seed',  type=int, required=False, default=0, help='Seed of the random number generator.')
+    parser.add_argument('--name',  type=str, required=False, default='synthetic', help='Base name of the images.')
+
+    namespace = parser.parse_args(sys.argv[1:])
+    height, width = namespace.size
+    make_dataset(namespace.outputdir, nfovs=namespace.nfovs, name=namespace.name, seed=namespace.seed, height=height, width=width, nchannels=namespace.nchannels, density=namespace.density)
@@ -17,6 +17,6 @@ python -m ensurepip
 python -m pip install pip --upgrade
 python -m pip install wheel
 
-python -m pip install numpy scipy matplotlib Pillow pyYAML termcolor opencv-python tifffile pims_nd2
+python -m pip install numpy scipy matplotlib Pillow pyYAML termcolor opencv-python tifffile pims_nd2 h5py
 
 echo "finished."
@@ -6,6 +6,20 @@ import numpy as np
 from pims_nd2 import ND2_Reader as ND2Reader
 #from pims import FramesSequenceND
 import tifffile as ti
+import multiprocessing
+import json
+import zlib
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# custom
+from utils import get_njobs, init_worker, make_dict_serializable, write_histograms, get_histogram_file, write_tiff, write_fov_table
+
+#################### global params ####################
+# ND2 reader opened by each worker process (see init_nd2_worker)
+ND2_WORKER = {}
 
 
 #class ImageReaderND(FramesSequenceND):
@@ -55,10 +69,304 @@ import tifffile as ti
 #       return np.array([[c, t, m]], dtype=np.uint8)
 
 #################### methods ####################
+def init_nd2_worker(nd2file):
+    """
+    Initialize a worker process for the parallel export: each worker opens its own reader on the ND2 file.
+    """
+    init_worker()
+    nd2_iterator = ND2Reader(nd2file)
+    nd2_iterator.iter_axes='m'
+    ND2_WORKER['reader'] = nd2_iterator
+    return
+
+def get_nd2_image(nd2_iterator, i, idx):
+    """
+    Read frame i of the ND2 iterator with channel selection and cropping.
+    INPUT:
+      * idx: filtering indexes. idx['y'] and idx['x'] are slices, idx['c'] is a slice when all channels are
+        selected and a list of channels otherwise.
+    OUTPUT:
+      * img: (c,y,x) array, the only copy made of the frame.
+      * frame: last frame read (for its metadata).
+
+    NOTE:
+      * with all channels, the frame is cropped with basic slices (a view) and copied once.
+      * with a subset of channels, only the selected channels are decoded, one at a time, directly into the output.
+    """
+    sy, sx = idx['y'], idx['x']
+    colors = idx['c']
+    if isinstance(colors, slice):
+        nd2_iterator.bundle_axes='cyx'
+        frame = nd2_iterator[i]
+        img = np.ascontiguousarray(frame[colors, sy, sx])
+    else:
+        nd2_iterator.bundle_axes='yx'
+        img = None
+        for k, c in enumerate(colors):
+            nd2_iterator.default_coords['c']=c
+            frame = nd2_iterator[i]
+            arr = frame[sy, sx]
+            if img is None:
+                img = np.empty((len(colors),)+arr.shape, dtype=arr.dtype)
+            img[k] = arr
+    return img, frame
+
+def get_frame_info(frame, img, fileout):
+    """
+    Return the information on an exported frame: acquisition time (t_ms), stage position (x_um, y_um, z_um),
+    pixel size (mpp), shape and name of the image. Values missing from the frame metadata are None.
+    """
+    info = {}
+    for key in ['t_ms', 'x_um', 'y_um', 'z_um', 'mpp']:
+        val = frame.metadata.get(key, None)
+        if not (val is None):
+            val = float(val)
+        info[key] = val
+    info['shape'] = [int(x) for x in img.shape]
+    info['file'] = os.path.basename(fileout)
+    return info
+
+def write_nd2_fov(nd2_iterator, fov, idx, fname, tiffdir, t=None, tiff_options=None):
+    """
+    Write the tiff image of one FOV, at time point t for time-lapses.
+    INPUT:
+      * nd2_iterator: reader iterating over FOVs.
+      * idx: filtering indexes.
+      * fname: file name format with a 'fov' field (and a 't' field for time-lapses).
+      * tiff_options: compression and tiling of the tiff file (see utils.get_tiff_write_kwargs).
+    OUTPUT:
+      * fov, t, path to the tiff file and information on the frame (see get_frame_info).
+    """
+    if t is None:
+        print "FOV {:d}".format(fov)
+    else:
+        print "FOV {:d}  t {:d}".format(fov,t)
+        nd2_iterator.default_coords['t']=t
+    img, frame = get_nd2_image(nd2_iterator, fov, idx)
+    fov_no = frame.frame_no
+    tiff_meta = frame.metadata
+    if (fov_no != fov):
+        print "Inconsistency for fov {:d}: fov_no={:d}".format(fov,fov_no)
+    # write tiff as a stack
+    fileout = os.path.join(tiffdir,fname.format(fov=fov,t=t)+'.tif')
+    write_tiff(fileout, img, metadata=tiff_meta, tiff_options=tiff_options)
+    print "{:<20s}{:<s}".format('fileout', fileout)
+    write_histograms(get_histogram_file(fileout), img)
+    return fov, t, fileout, get_frame_info(frame, img, fileout)
+
+def write_nd2_fov_worker(job):
+    """
+    Write the tiff image of one FOV with the reader of the current worker process.
+    """
+    fov, t, idx, fname, tiffdir, tiff_options = job
+    return write_nd2_fov(ND2_WORKER['reader'], fov, idx, fname, tiffdir, t=t, tiff_options=tiff_options)
+
+def get_export_params(nd2file, idx, output_format='tiff', tiff_options=None):
+    """
+    Return the parameters of an export that determine the content of the tiff files: ND2 file, channels, crops,
+    output format, and compression and tiling of the files (the number of encoding threads is left out).
+    The parameters are normalized as in the JSON manifest, so that they can be compared to its entries.
+    """
+    colors = idx['c']
+    if isinstance(colors, slice):
+        colors = range(colors.start, colors.stop)
+    params = {}
+    params['nd2'] = os.path.basename(nd2file)
+    params['colors'] = [int(c) for c in colors]
+    params['ycrop'] = [idx['y'].start, idx['y'].stop]
+    params['xcrop'] = [idx['x'].start, idx['x'].stop]
+    params['output_format'] = output_format
+    if tiff_options is None:
+        tiff_options = {}
+    params['tiff_options'] = {k: v for k, v in tiff_options.items() if (k != 'maxworkers') and not (v is None)}
+    return json.loads(json.dumps(make_dict_serializable(params)))
+
+def get_file_crc32(filein):
+    """
+    Return the CRC32 checksum of a file.
+    """
+    crc = 0
+    with open(filein,'rb') as fin:
+        for block in iter(lambda: fin.read(2**20), b''):
+            crc = zlib.crc32(block, crc)
+    return crc & 0xffffffff
+
+def make_manifest_entry(result, params):
+    """
+    Make the manifest entry of an exported tiff file.
+    INPUT:
+      * result: (fov, t, path to the tiff file, frame information) as returned by write_nd2_fov.
+      * params: export parameters (see get_export_params).
+    """
+    fov, t, fileout, info = result
+    with ti.TiffFile(fileout) as tif:
+        series = tif.series[0]
+        shape = [int(x) for x in series.shape]
+        dtype = str(np.dtype(series.dtype))
+    entry = {'file': os.path.basename(fileout), 'fov': fov, 't': t, 'info': info, 'params': params, 'shape': shape, 'dtype': dtype, 'crc32': get_file_crc32(fileout)}
+    return entry
+
+def append_manifest(pathtomanifest, entry):
+    """
+    Append an entry to the manifest (one JSON dictionary per line).
+    """
+    with open(pathtomanifest, 'a') as fout:
+        fout.write(json.dumps(entry) + '\n')
+    return
 
-def process_nd2_tiff(nd2file, tstart=None, tend=None, fovs=None, colors=None, xcrop=None, ycrop=None, tiffdir='TIFF'):
+def load_manifest(pathtomanifest):
+    """
+    Load the manifest of an export as a dictionary of entries indexed by file name. Later entries prevail.
+    """
+    manifest = {}
+    if not os.path.isfile(pathtomanifest):
+        return manifest
+    with open(pathtomanifest, 'r') as fin:
+        for line in fin:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # truncated line of an interrupted export
+                continue
+            manifest[entry['file']] = entry
+    return manifest
+
+def check_manifest_entry(entry, params, tiffdir):
+    """
+    Check that a manifest entry was exported with the same parameters and that its tiff file is unchanged.
+    """
+    if (entry is None) or not ('info' in entry) or (entry['params'] != params):
+        return False
+    fileout = os.path.join(tiffdir, entry['file'])
+    if not os.path.isfile(fileout):
+        return False
+    return get_file_crc32(fileout) == entry['crc32']
+
+def get_json(mydict):
+    """
+    Serialize frame metadata in JSON format.
+    """
+    return json.dumps(make_dict_serializable(dict(mydict)), default=lambda v: v.tolist() if hasattr(v, 'tolist') else str(v))
+
+def write_nd2_store(nd2_iterator, frames, idx, fname, storefile, metadata=None, compression='gzip', compression_opts=4, chunk_size=256):
+    """
+    Write the images of the selected frames in a single chunked and compressed HDF5 array store.
+    INPUT:
+      * nd2_iterator: reader iterating over FOVs.
+      * frames: list of (fov, t) to write, t being None when there is no time axis.
+      * idx: filtering indexes.
+      * fname: format of the names of the images, with a 'fov' field (and a 't' field for time-lapses).
+      * metadata: metadata of the ND2 file, written as an attribute of the store.
+      * compression, compression_opts: HDF5 compression filter and its options.
+      * chunk_size: chunks span one channel and chunk_size x chunk_size pixels.
+    OUTPUT:
+      * list of (fov, t, reference to the image, frame information).
+
+    NOTE:
+      * the 'images' dataset has the layout (fov, c, y, x), or (fov, t, c, y, x) for time-lapses.
+      * the 'frames' group holds one entry per image: fov, t, acquisition time, stage position, name and
+        metadata (JSON).
+      * frames are read and written one at a time.
+    """
+    if h5py is None:
+        raise ValueError("h5py is required to write array stores.")
+    fovs = []
+    tps = []
+    for fov, t in frames:
+        if not (fov in fovs):
+            fovs.append(fov)
+        if not (t is None) and not (t in tps):
+            tps.append(t)
+    timelapse = (len(tps) > 0)
+    if compression != 'gzip':
+        compression_opts = None
+
+    nframes = len(frames)
+    positions = {}
+    for key in ['t_ms', 'x_um', 'y_um', 'z_um']:
+        positions[key] = np.full(nframes, np.nan, dtype=np.float_)
+    names = []
+    metas = []
+    results = []
+    with h5py.File(storefile, 'w') as fout:
+        dset = None
+        for n in range(nframes):
+            fov, t = frames[n]
+            if t is None:
+                print "FOV {:d}".format(fov)
+            else:
+                print "FOV {:d}  t {:d}".format(fov,t)
+                nd2_iterator.default_coords['t']=t
+            img, frame = get_nd2_image(nd2_iterator, fov, idx)
+            if dset is None:
+                nchannels, height, width = img.shape
+                chunks = (1, 1, min(chunk_size, height), min(chunk_size, width))
+                shape = (len(fovs), nchannels, height, width)
+                if timelapse:
+                    chunks = (1,) + chunks
+                    shape = (len(fovs), len(tps), nchannels, height, width)
+                dset = fout.create_dataset('images', shape=shape, dtype=img.dtype, chunks=chunks, compression=compression, compression_opts=compression_opts, shuffle=True)
+                dset.attrs['fovs'] = np.array(fovs, dtype=np.int_)
+                dset.attrs['timepoints'] = np.array(tps, dtype=np.int_)
+                dset.attrs['timelapse'] = timelapse
+                dset.attrs['axes'] = 'ftcyx' if timelapse else 'fcyx'
+                if not (metadata is None):
+                    fout.attrs['metadata'] = get_json(metadata)
+            i = fovs.index(fov)
+            if timelapse:
+                dset[i, tps.index(t)] = img
+            else:
+                dset[i] = img
+
+            # frame information
+            for key in positions:
+                val = frame.metadata.get(key, None)
+                if not (val is None):
+                    positions[key][n] = float(val)
+            names.append(fname.format(fov=fov,t=t))
+            write_histograms(os.path.join(os.path.dirname(storefile), 'histograms', names[-1]+'.npz'), img)
+            metas.append(get_json(frame.metadata))
+            ref = "{}::{:d}".format(storefile, fov)
+            if timelapse:
+                ref += "::{:d}".format(t)
+            results.append((fov, t, ref, get_frame_info(frame, img, names[-1]+'.tif')))
+
+        grp = fout.create_group('frames')
+        grp.create_dataset('fov', data=np.array([fov for fov,t in frames], dtype=np.int_))
+        grp.create_dataset('t', data=np.array([(-1 if t is None else t) for fov,t in frames], dtype=np.int_))
+        for key in positions:
+            grp.create_dataset(key, data=positions[key])
+        strtype = h5py.special_dtype(vlen=str)
+        grp.create_dataset('name', data=np.array(names, dtype=object), dtype=strtype)
+        grp.create_dataset('metadata', data=np.array(metas, dtype=object), dtype=strtype)
+    print "{:<20s}{:<s}".format('fileout', storefile)
+
+    return results
+
+def process_nd2_tiff(nd2file, tstart=None, tend=None, fovs=None, colors=None, xcrop=None, ycrop=None, tiffdir='TIFF', njobs=1, output_format='tiff', store=None, resume=False, tiff_options=None):
     """
     Write tiff images contained in an ND2 file and return the meta data.
+    With njobs > 1, the FOVs are split into contiguous shards exported by several worker processes,
+    each with its own reader on the ND2 file.
+
+    Time-lapses are exported one (fov, t) frame at a time, with one tiff file per FOV and time point
+    between tstart and tend, so that the memory used does not depend on the number of time points.
+    The acquisition time of each frame is given in the 'timestamps' entry of the returned meta data.
+
+    With output_format='hdf5', all the frames are written in a single chunked and compressed array store
+    '<name>.h5' in tiffdir instead of one tiff file per frame (see write_nd2_store, whose options are given
+    in the store dictionary). The store is written by a single process.
+
+    The position, acquisition time, pixel size, shape and file of each exported frame are written in the table
+    'fovs.txt' in tiffdir (see utils.load_fov_table).
+
+    Each exported tiff file is recorded in 'manifest.txt' in tiffdir, with the export parameters, the shape,
+    the type and the checksum of the file. With resume=True, the frames whose entry matches are not exported again.
+
+    The compression and tiling of the tiff files are set by tiff_options (see utils.get_tiff_write_kwargs).
     """
     # check file existence
     if not os.path.isfile(nd2file):
@@ -120,7 +428,9 @@ def process_nd2_tiff(nd2file, tstart=None, tend=None, fovs=None, colors=None, xc
             colors = np.arange(nc)
         for i in colors:
             print "Channel {:d} selected".format(i)
-        idx['c']=colors
+        idx['c']=[int(c) for c in colors]
+        if idx['c'] == range(nc):
+            idx['c']=slice(0,nc)
 
     ## cropping
     if not ('x' in axes) and ('y' in axes):
@@ -138,7 +448,7 @@ def process_nd2_tiff(nd2file, tstart=None, tend=None, fovs=None, colors=None, xc
         print "Problem with y-cropping: ylo = {:d}    yhi = {:d}".format(ylo,yhi)
     if np.mod(yhi+1-ylo,2) == 1:
         yhi = yhi - 1
-    idx['y']=np.arange(ylo,yhi+1, dtype=np.uint)
+    idx['y']=slice(int(ylo),int(yhi)+1)
 
     ### x
     nx = sizes['x']
@@ -154,7 +464,7 @@ def process_nd2_tiff(nd2file, tstart=None, tend=None, fovs=None, colors=None, xc
         print "Problem with x-cropping: xlo = {:d}    xhi = {:d}".format(xlo,xhi)
     if np.mod(xhi+1-xlo,2) == 1:
         xhi = xhi - 1
-    idx['x']=np.arange(xlo,xhi+1,dtype=np.uint)
+    idx['x']=slice(int(xlo),int(xhi)+1)
 
 
 #    if 't' in axes:
@@ -164,41 +474,74 @@ def process_nd2_tiff(nd2file, tstart=None, tend=None, fovs=None, colors=None, xc
 #        print len(nd2_iterator)
 #        nd2_iterator.bundle_axes='tcyx'
 #    else:
-    nd2_iterator.bundle_axes='cyx'
 
 #    print nd2_iterator.axes
 #    print nd2_iterator.sizes
     # format for file out
 
+    results = []
     if 'm' in axes:
         nd2_iterator.iter_axes='m'
-        print "Starting per-FOV writing"
-        for fov in idx['m']:
-            print "FOV {:d}".format(fov)
-            frame = nd2_iterator[fov]
-            fov_no = frame.frame_no
-            tiff_meta = frame.metadata
-            if (fov_no != fov):
-                print "Inconsistency for fov {:d}: fov_no={:d}".format(fov,fov_no)
-            if 't' in axes:
-                raise ValueError("Time axis handling not implemented yet.")
-                frame.iter_axes='t'
+        fovs = [int(fov) for fov in idx['m']]
+        if 't' in axes:
+            fname = "{}_{}_{}".format(bname,fmtdict['m'],fmtdict['t'])
+            frames = [(fov, int(t)) for fov in fovs for t in idx['t']]
+        else:
+            fname = "{}_{}".format(bname,fmtdict['m'])
+            frames = [(fov, None) for fov in fovs]
+        nframes = len(frames)
+        if output_format == 'hdf5':
+            print "Starting per-FOV writing in array store"
+            storefile = os.path.join(tiffdir, bname+'.h5')
+            if store is None:
+                store = {}
+            results = write_nd2_store(nd2_iterator, frames, idx, fname, storefile, metadata=nd2_iterator.metadata, **store)
+        elif output_format != 'tiff':
+            raise ValueError("Output format not implemented: {}".format(output_format))
+        else:
+            # manifest
+            pathtomanifest = os.path.join(tiffdir, 'manifest.txt')
+            export_params = get_export_params(nd2file, idx, output_format=output_format, tiff_options=tiff_options)
+            if resume:
+                manifest = load_manifest(pathtomanifest)
+                todo = []
+                for fov,t in frames:
+                    entry = manifest.get(fname.format(fov=fov,t=t)+'.tif', None)
+                    if check_manifest_entry(entry, export_params, tiffdir) and os.path.isfile(get_histogram_file(os.path.join(tiffdir, entry['file']))):
+                        results.append((fov, t, os.path.join(tiffdir, entry['file']), entry['info']))
+                    else:
+                        todo.append((fov,t))
+                print "{:<20s}{:<d}".format('nskipped', len(results))
+                frames = todo
+                nframes = len(frames)
+            elif os.path.isfile(pathtomanifest):
+                os.remove(pathtomanifest)
+
+            # the decoded frame and its cropped copy
+            mem_per_job = 2*sizes['c']*sizes['y']*sizes['x']*np.dtype(nd2_iterator.pixel_type).itemsize
+            njobs = min(get_njobs(njobs, mem_per_job=mem_per_job), nframes)
+            if njobs > 1:
+                print "Starting per-FOV writing with {:d} workers".format(njobs)
+                # contiguous shards of FOVs
+                chunksize = int(np.ceil(float(nframes)/njobs))
+                jobs = [(fov, t, idx, fname, tiffdir, tiff_options) for fov,t in frames]
+                pool = multiprocessing.Pool(processes=njobs, initializer=init_nd2_worker, initargs=(nd2file,))
+                try:
+                    for res in pool.imap(write_nd2_fov_worker, jobs, chunksize=chunksize):
+                        append_manifest(pathtomanifest, make_manifest_entry(res, export_params))
+                        results.append(res)
+                finally:
+                    pool.close()
+                    pool.join()
             else:
-                fmt=fmtdict['m']
-                img = np.array(frame)
-                # filtering
-                ## color
-                img = img[idx['c']]
-                ## y cropping
-                img = img[:, idx['y']]
-                ## x cropping
-                img = img[:,:,idx['x']]
-                # write tiff as a stack
-                fname = "{}_{}".format(bname,fmt)
-                fname = fname.format(fov=fov)
-                fileout = os.path.join(tiffdir,fname+'.tif')
-                ti.imwrite(fileout, img, imagej=True, photometric='minisblack',metadata=tiff_meta)
-                print "{:<20s}{:<s}".format('fileout', fileout)
+                print "Starting per-FOV writing"
+                for fov,t in frames:
+                    res = write_nd2_fov(nd2_iterator, fov, idx, fname, tiffdir, t=t, tiff_options=tiff_options)
+                    append_manifest(pathtomanifest, make_manifest_entry(res, export_params))
+                    results.append(res)
+            # merge
+            results.sort()
+            print "{:<20s}{:<d}".format('ntiffs', len(results))
     else:
         frame = nd2_iterator
         tiff_meta = frame.metadata
@@ -208,35 +551,42 @@ def process_nd2_tiff(nd2file, tstart=None, tend=None, fovs=None, colors=None, xc
             fmt = fmtdict['t']
             fname = bname + "_" + fmt
             for t in idx['t']:
-                img = np.array(frame[t])
-                # filtering
-                ## color
-                img = img[idx['c']]
-                ## y cropping
-                img = img[:, idx['y']]
-                ## x cropping
-                img = img[:,:,idx['x']]
+                img, tframe = get_nd2_image(frame, t, idx)
                 # write tiff as a stack
                 fileout = os.path.join(tiffdir,fname.format(t=t) +'.tif')
-                ti.imwrite(fileout, img, imagej=True, photometric='minisblack',metadata=tiff_meta)
+                write_tiff(fileout, img, metadata=tiff_meta, tiff_options=tiff_options)
                 print "{:<20s}{:<s}".format('fileout', fileout)
-            sys.exit()
+                write_histograms(get_histogram_file(fileout), img)
+                results.append((None, int(t), fileout, get_frame_info(tframe, img, fileout)))
         else:
-            img = np.array(frame[0])
-            # filtering
-            ## color
-            img = img[idx['c']]
-            ## y cropping
-            img = img[:, idx['y']]
-            ## x cropping
-            img = img[:,:,idx['x']]
+            img, tframe = get_nd2_image(frame, 0, idx)
             # write tiff as a stack
             fname = bname
             fileout = os.path.join(tiffdir,fname+'.tif')
-            ti.imwrite(fileout, img, imagej=True, photometric='minisblack',metadata=tiff_meta)
+            write_tiff(fileout, img, metadata=tiff_meta, tiff_options=tiff_options)
             print "{:<20s}{:<s}".format('fileout', fileout)
+            write_histograms(get_histogram_file(fileout), img)
+            results.append((None, None, fileout, get_frame_info(tframe, img, fileout)))
+
+    # table of FOVs
+    records = []
+    for fov, t, fileout, info in results:
+        record = dict(info)
+        record['fov'] = (0 if fov is None else fov)
+        record['t'] = (-1 if t is None else t)
+        records.append(record)
+    pathtotable = os.path.join(tiffdir, 'fovs.txt')
+    write_fov_table(pathtotable, records)
+    print "{:<20s}{:<s}".format('fileout', pathtotable)
+
+    metainfo = dict(nd2_iterator.metadata)
+    if 't' in axes:
+        timestamps = []
+        for fov, t, fileout, info in results:
+            timestamps.append({'fov': fov, 't': t, 't_ms': info['t_ms'], 'file': os.path.relpath(fileout, tiffdir)})
+        metainfo['timestamps'] = timestamps
 
-    return nd2_iterator.metadata
+    return metainfo
 
 #    # get the color names out. Kinda roundabout way.
 #    planes = [nd2f.metadata[md]['name'] for md in nd2f.metadata if md[0:6] == u'plane_' and not md == u'plane_count']
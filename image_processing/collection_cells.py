@@ -13,6 +13,8 @@ import cPickle as pkl
 
 # custom
 from utils import *
+import componentslib as cpl
+import geometrylib as geo
 
 #################### global params ####################
 # yaml formats
@@ -35,6 +37,8 @@ def default_parameters():
     params['collection']={}
     mydict = params['collection']
     mydict['px2um'] = None
+    mydict['write_json'] = False
+    mydict['tiff_options'] = {'compression': None, 'level': None, 'predictor': True, 'tile': None, 'maxworkers': None}
 
     return params
 
@@ -75,13 +79,13 @@ def check_segmentation(sdir):
             print "Problem with file {:s}".format(f)
             return False
 
-        # check estimator file
-        if not check_estimator_file(ef):
+        # check estimator file (might not be written in fused mode)
+        if (os.path.basename(ef) != 'None') and not check_estimator_file(ef):
             print "Problem with file {:s}".format(ef)
             return False
 
-        # check mask file
-        if not check_mask_file(mf):
+        # check mask file (might not be written in fused mode)
+        if (os.path.basename(mf) != 'None') and not check_mask_file(mf):
             print "Problem with file {:s}".format(mf)
             return False
 
@@ -92,9 +96,10 @@ def check_segmentation(sdir):
 
     return True
 
-def write_crop(img, mask, points, bname, tiff_dir='.', mask_dir='.', pad_x=5, pad_y=5, debug=False):
+def write_crop(img, mask, points, bname, label=None, tiff_dir='.', mask_dir='.', pad_x=5, pad_y=5, debug=False, tiff_options=None):
     """
     Return a cropped image where the clipping mask is the bounding box of the input points.
+    If label is given, mask is a label matrix and the clipping mask is made of the pixels with that label.
     """
     shape= img.shape
     if len(shape) == 2:
@@ -117,6 +122,8 @@ def write_crop(img, mask, points, bname, tiff_dir='.', mask_dir='.', pad_x=5, pa
     # crop
     submask= mask[y0:y1+1]
     submask = submask[:, x0:x1+1]
+    if not (label is None):
+        submask = (submask == label)
     if nchannel is None:
         subimg = img[:, y0:y1+1]
         subimg = subimg[:, x0:x1+1]
@@ -160,14 +167,14 @@ def write_crop(img, mask, points, bname, tiff_dir='.', mask_dir='.', pad_x=5, pa
 
     # write tiff
     fileout = os.path.join(tiff_dir,bname+'.tif')
-    ti.imwrite(fileout, subimg, imagej=True, photometric='minisblack')
+    write_tiff(fileout, subimg, tiff_options=tiff_options)
     print "{:<20s}{:<s}".format('fileout',fileout)
 
     # write
     fileout = os.path.join(mask_dir,bname+'.tif')
     #fileout = os.path.join(mask_dir,bname+'.txt')
     #np.savetxt(fileout,submask)
-    ti.imwrite(fileout, np.array(255*submask,dtype=np.uint8), imagej=True, photometric='minisblack')
+    write_tiff(fileout, np.array(255*submask,dtype=np.uint8), tiff_options=tiff_options)
     print "{:<20s}{:<s}".format('fileout',fileout)
 
     return
@@ -212,6 +219,8 @@ if __name__ == "__main__":
     paramfile = dest
 
     params=allparams['collection']
+    if params.get('write_cropped', False):
+        check_tiff_options(params.get('tiff_options', None))
 
     # debug or not
     if namespace.debug:
@@ -223,6 +232,14 @@ if __name__ == "__main__":
         raise ValueError("Metadata missing at {:s}".format(pathtometa,rootdir))
     meta = load_json2dict(pathtometa)
 
+    # table of FOVs (positions and pixel sizes of all images in a single read)
+    pathtotable = os.path.join(rootdir,'fovs.txt')
+    fov_table = None
+    if os.path.isfile(pathtotable):
+        fov_table = load_fov_table(pathtotable)
+        fov_index = get_fov_index(fov_table)
+        print "{:<20s}{:<s}".format("fov table", pathtotable)
+
     # CHECK EXISTING SEGMENTATION
     seg_dir = os.path.relpath(os.path.join(outputdir, '..', 'segmentation'))
     has_segmentation = check_segmentation(seg_dir)
@@ -243,9 +260,16 @@ if __name__ == "__main__":
     fmt="x{{x:0{:d}d}}".format(int(np.log10(t_width))+1)
     fmtdict['x']=fmt
     cell_id_fmt = fmtdict['fov'] + fmtdict['y'] + fmtdict['x']
+    if not (fov_table is None) and (len(fov_table['t']) > 0) and (np.max(fov_table['t']) >= 0):
+        # time-lapse: one image per (fov, t)
+        nt = np.max(fov_table['t'])+1
+        fmt="t{{t:0{:d}d}}".format(int(np.log10(nt))+1)
+        fmtdict['t']=fmt
+        cell_id_fmt = fmtdict['fov'] + fmtdict['t'] + fmtdict['y'] + fmtdict['x']
 
     # MAKE CELL COLLECTION
     cells = []
+    pixels = []
     tiff_dir = os.path.join(outputdir,'tiffs')
     if not os.path.isdir(tiff_dir):
         os.makedirs(tiff_dir)
@@ -265,60 +289,67 @@ if __name__ == "__main__":
         print "Processing file {:d} / {:d}".format(n,nfiles)
         f = os.path.relpath(os.path.join(seg_dir,f))
         print f
-        with ti.TiffFile(f) as tif:
-            img = tif.asarray()
-            meta = tif.imagej_metadata
+        img, meta = get_tiff2ndarray(f, channel=None, metadata=True, normalize=False)
+        row = None
+        if not (fov_table is None):
+            row = fov_index.get(get_image_name(f), None)
         if mpp is None:
-            try:
-                mpp = float(meta['mpp'])
+            if not (row is None) and np.isfinite(fov_table['mpp'][row]):
+                mpp = float(fov_table['mpp'][row])
                 print "mpp = {:.6f}".format(mpp)
-            except KeyError, ValueError:
-                print "Unit is lacking: mpp = 1!"
-                mpp = 1.
-        fov = meta['m']
+            else:
+                try:
+                    mpp = float(meta['mpp'])
+                    print "mpp = {:.6f}".format(mpp)
+                except KeyError, ValueError:
+                    print "Unit is lacking: mpp = 1!"
+                    mpp = 1.
+        if row is None:
+            fov = meta['m']
+            t = -1
+            stage_pos = (np.nan, np.nan)
+        else:
+            fov = int(fov_table['fov'][row])
+            t = int(fov_table['t'][row])
+            stage_pos = (float(fov_table['x_um'][row]), float(fov_table['y_um'][row]))
         nchannels, height, width = img.shape
         print img.dtype
         print img.shape
 
-        # make meshgrid
-        Y,X = np.mgrid[0:height,0:width]
-
         # load labels
         lf = os.path.relpath(os.path.join(seg_dir,lf))
         print lf
-        labels = ssp.load_npz(lf).todense()
+        labels = load_labels(lf)
         nlabels = np.max(labels)
         if nlabels == 0:
             print "No labels detected"
             continue
+        slices = cpl.get_label_slices(labels, nlabels)
 
-        # compute background
-        mask_bg = (labels == 0)
-        val_bg = img[:,mask_bg]
-        channel_bg = np.median(val_bg, axis=1)
-
+        # compute area and fluorescence of all objects at once (background from label 0)
+        features = cpl.get_label_features(img, labels, nlabels)
 
         # iterate over segmented objects
-        for n in range(1, nlabels):
+        for n in range(1, nlabels+1):
             cell = {}
             print "Getting cell {:d} / {:d} for FOV {:d}".format(n,nlabels,fov)
 
-            # make index
-            mask = (labels == n)
-
             # fov
             cell['fov']=fov
             cell['mpp']=mpp
+            if not (fov_table is None):
+                # time point (-1 if not a time-lapse) and stage position of the FOV
+                cell['t']=t
+                cell['stage_x_um']=stage_pos[0]
+                cell['stage_y_um']=stage_pos[1]
 
             # get points
-            points = np.transpose([X[mask],Y[mask]])
-            P = len(points)
-            cell['pixels']={}
-            cell['pixels']['xcoord']=points[:,0]
-            cell['pixels']['ycoord']=points[:,1]
-
-            # rotated bounding box
-            bb = cv2.minAreaRect(points)
+            points = cpl.get_component_points(labels, n, slices[n])
+            P = int(features['area'][n])
+
+            # rotated bounding box (from the outer contour)
+            contour = geo.get_label_points(labels, n, slices[n])
+            bb, bb_upright = geo.get_boxes(contour)
             xymid,wh,angle=bb
             w,h=wh
             cell['bounding_box_rotated']={}
@@ -345,29 +376,41 @@ if __name__ == "__main__":
             cell['volume_um3']=cell['volume']*mpp*mpp*mpp
 
             # fluorescence
-            val = img[:,mask]
             cell['fluorescence']={}
-            cell['fluorescence']['background_px']=channel_bg
-            cell['fluorescence']['background_cell']=channel_bg*len(points)
-            cell['fluorescence']['total']=np.sum(val,axis=1)
+            cell['fluorescence']['background_px']=features['background_px']
+            cell['fluorescence']['background_cell']=features['background_cell'][n]
+            cell['fluorescence']['total']=features['total'][n]
+            cell['fluorescence']['total_corrected']=features['total_corrected'][n]
 
             # id
-            cell_id = cell_id_fmt.format(fov=fov,y=int(xymid[1]),x=int(xymid[0]))
+            cell_id = cell_id_fmt.format(fov=fov,t=t,y=int(xymid[1]),x=int(xymid[0]))
             cell['id']=cell_id
 
             # add to list
             cells.append(cell)
+            pixels.append(points)
 
             # write tiff
             if params['write_cropped']:
-                write_crop(img, mask, points, bname=cell_id, tiff_dir=tiff_dir, mask_dir=mask_dir,debug=namespace.debug, **params['crops'])
+                write_crop(img, labels, contour, bname=cell_id, label=n, tiff_dir=tiff_dir, mask_dir=mask_dir,debug=namespace.debug, tiff_options=params.get('tiff_options', None), **params['crops'])
 
     ncells = len(cells)
     print "ncells = {:d} collected".format(ncells)
 
-# write down the cell dictionary
-    celldict = {cell['id']: cell for cell in cells}
-    celldict = make_dict_serializable(celldict)
-    pathtocells = os.path.join(outputdir, 'collection.js')
-    write_dict2json(pathtocells,celldict)
-    print "{:<20s}{:<s}".format('fileout', pathtocells)
+    # write down the cell collection in columnar format
+    pathtocolumns = os.path.join(outputdir, 'columns')
+    write_collection_columns(pathtocolumns, cells)
+    print "{:<20s}{:<s}".format('fileout', pathtocolumns)
+
+    # write down the pixels of all cells
+    pathtopixels = os.path.join(outputdir, 'pixels')
+    write_collection_pixels(pathtopixels, [cell['id'] for cell in cells], pixels)
+    print "{:<20s}{:<s}".format('fileout', pathtopixels)
+
+    # write down the cell dictionary
+    if params.get('write_json', False):
+        celldict = {cell['id']: cell for cell in cells}
+        celldict = make_dict_serializable(celldict)
+        pathtocells = os.path.join(outputdir, 'collection.js')
+        write_dict2json(pathtocells,celldict)
+        print "{:<20s}{:<s}".format('fileout', pathtocells)
@@ -0,0 +1,142 @@
+#################### imports ####################
+import numpy as np
+import cv2
+import scipy.ndimage as simg
+
+#################### methods ####################
+def get_slices(stats):
+    """
+    Convert the statistics returned by cv2.connectedComponentsWithStats into bounding slices.
+    INPUT:
+      * stats: (ncomp, 5) array with left, top, width, height and area of each component.
+    OUTPUT:
+      * list of (slice_y, slice_x) tuples, one per component, in the style of scipy.ndimage.find_objects.
+    """
+    slices = []
+    for x, y, w, h, area in stats:
+        if area == 0:
+            # empty label (eg background of a fully covered image)
+            slices.append((slice(0,0), slice(0,0)))
+        else:
+            slices.append((slice(y, y+h), slice(x, x+w)))
+    return slices
+
+def get_components(img, connectivity=8):
+    """
+    Find the connected components of a binary image together with their bounding slices in a single pass.
+    INPUT:
+      * img: 8-bit binary image.
+    OUTPUT:
+      * ncomp: number of components (including the background with label 0).
+      * labels: label matrix (int32) of same size as img.
+      * areas: number of pixels in each component.
+      * slices: bounding slices (slice_y, slice_x) of each component.
+    """
+    ncomp, labels, stats, centroids = cv2.connectedComponentsWithStats(img, connectivity=connectivity)
+    areas = stats[:, cv2.CC_STAT_AREA]
+    slices = get_slices(stats)
+
+    return ncomp, labels, areas, slices
+
+def relabel_components(components, scores, threshold=0.):
+    """
+    Build a label matrix from the connected components whose score is above a threshold.
+    The components that pass are renumbered consecutively from 1 with a lookup table, in the same order
+    as they would be found by running cv2.connectedComponents on the thresholded mask.
+    The background (component 0) is never selected.
+    INPUT:
+      * components: matrix of connected components.
+      * scores: table of scores for each component.
+      * threshold: minimum score (excluded).
+    OUTPUT:
+      * labels: label matrix (int32).
+      * component_ids: index of the original component for each label (label n comes from component_ids[n-1]).
+    """
+    keep = np.asarray(scores) > threshold
+    keep[0] = False
+    component_ids = np.flatnonzero(keep)
+    lut = np.zeros(len(keep), dtype=np.int32)
+    lut[component_ids] = np.arange(1, len(component_ids)+1, dtype=np.int32)
+    labels = lut[components]
+
+    return labels, component_ids
+
+def get_label_slices(labels, nlabels=None):
+    """
+    Return the bounding slices of all labels of a label matrix in a single pass.
+    OUTPUT:
+      * list of (slice_y, slice_x) tuples such that slices[n] is the bounding slice of label n.
+        Entry 0 is the full image and missing labels have empty slices.
+    """
+    height,width = labels.shape
+    slices = [(slice(0,height), slice(0,width))]
+    for sl in simg.find_objects(labels, max_label=(0 if nlabels is None else nlabels)):
+        if sl is None:
+            sl = (slice(0,0), slice(0,0))
+        slices.append(sl)
+    return slices
+
+def get_component_mask(labels, n, sl):
+    """
+    Return the binary mask of component n restricted to its bounding slice.
+    """
+    return (labels[sl] == n)
+
+def get_component_points(labels, n, sl):
+    """
+    Return the pixel coordinates of component n as an array of (x,y) points.
+    Only the bounding slice of the component is visited. Points are sorted in row-major order,
+    as they would be when indexing the full image.
+    """
+    sy, sx = sl
+    ys, xs = np.nonzero(get_component_mask(labels, n, sl))
+    points = np.transpose([xs + sx.start, ys + sy.start])
+
+    return points
+
+def get_label_features(img, labels, nlabels=None):
+    """
+    Compute the area and fluorescence of all labels at once, with reductions over the label matrix.
+    INPUT:
+      * img: image with shape (nchannels, height, width).
+      * labels: label matrix. Label 0 is the background.
+    OUTPUT:
+      * dictionary of arrays indexed by label:
+          - area: number of pixels.
+          - total: (nlabels+1, nchannels) sum of the pixel values in each channel.
+          - background_cell: (nlabels+1, nchannels) background contribution to the total.
+          - total_corrected: (nlabels+1, nchannels) background-corrected total.
+        and the per-channel background value 'background_px' (median of the pixels with label 0).
+    """
+    nchannels = img.shape[0]
+    if nlabels is None:
+        nlabels = np.max(labels)
+    flat = np.ravel(labels)
+    nbins = nlabels+1
+
+    # area
+    area = np.bincount(flat, minlength=nbins)[:nbins]
+
+    # totals (with the same type as np.sum)
+    sum_dtype = np.sum(np.zeros(0, dtype=img.dtype)).dtype
+    total = np.zeros((nbins, nchannels), dtype=sum_dtype)
+    for c in range(nchannels):
+        val = np.bincount(flat, weights=np.ravel(img[c]), minlength=nbins)[:nbins]
+        if np.issubdtype(sum_dtype, np.integer):
+            val = np.rint(val)
+        total[:,c] = val
+
+    # background
+    mask_bg = (labels == 0)
+    background_px = np.median(img[:,mask_bg], axis=1)
+    background_cell = np.outer(area, background_px)
+    total_corrected = total - background_cell
+
+    features = {}
+    features['area'] = area
+    features['total'] = total
+    features['background_px'] = background_px
+    features['background_cell'] = background_cell
+    features['total_corrected'] = total_corrected
+
+    return features
@@ -0,0 +1,63 @@
+#################### imports ####################
+import numpy as np
+import cv2
+
+#################### methods ####################
+def get_label_points(labels, n, sl, mode='contour'):
+    """
+    Return the (x,y) points describing the outline of label n.
+    INPUT:
+      * labels: label matrix.
+      * n: label of the object.
+      * sl: bounding slice (slice_y, slice_x) of the object.
+      * mode: 'contour' for the outer contour pixels, 'hull' for the vertices of the convex hull.
+    OUTPUT:
+      * array of int32 points of shape (N,2).
+
+    NOTE:
+      * the convex hull of a set of pixels is the convex hull of its outer contour. Hence bounding boxes
+        computed from these points are the same as those computed from all the pixels of the object.
+      * only the bounding slice of the object is visited, and no full-image coordinate grid is allocated.
+    """
+    sy, sx = sl
+    if (sy.stop <= sy.start) or (sx.stop <= sx.start):
+        return np.zeros((0,2), dtype=np.int32)
+    # pad by one pixel so that objects touching the edge of the slice are traced properly
+    sub = np.zeros((sy.stop-sy.start+2, sx.stop-sx.start+2), dtype=np.uint8)
+    sub[1:-1,1:-1] = (labels[sl] == n)
+    res = cv2.findContours(sub, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(int(sx.start)-1, int(sy.start)-1))
+    contours = res[-2] # the signature of findContours depends on the OpenCV version
+    if len(contours) == 0:
+        return np.zeros((0,2), dtype=np.int32)
+    points = np.concatenate([np.reshape(c, (-1,2)) for c in contours])
+
+    if mode == 'contour':
+        pass
+    elif mode == 'hull':
+        points = np.reshape(cv2.convexHull(points), (-1,2))
+    else:
+        raise ValueError("Mode not implemented: {}".format(mode))
+
+    return points
+
+def get_boxes(points):
+    """
+    Return the rotated and upright bounding boxes of a set of (x,y) points.
+    OUTPUT:
+      * rotated box ((x,y) center, (w,h), angle) as returned by cv2.minAreaRect.
+      * upright box (x,y,w,h) as returned by cv2.boundingRect.
+    """
+    if len(points) == 0:
+        return ((0.,0.),(0.,0.),0.), (0,0,0,0)
+    bb = cv2.minAreaRect(points)
+    bb_upright = cv2.boundingRect(points)
+
+    return bb, bb_upright
+
+def get_label_boxes(labels, n, sl, mode='contour'):
+    """
+    Return the rotated and upright bounding boxes of label n, computed from its outline only.
+    """
+    points = get_label_points(labels, n, sl, mode=mode)
+
+    return get_boxes(points)
@@ -12,6 +12,7 @@ import tifffile as ti
 import cv2
 import cPickle as pkl
 import scipy.ndimage as simg
+import time
 
 # custom
 from utils import *
@@ -27,6 +28,24 @@ yaml.add_representer(np.float_,npfloat_representer)
 yaml.add_representer(np.ndarray,nparray_representer)
 yaml.add_representer(unicode,unicode_representer)
 
+# rough upper bound of the memory used to process one FOV, in units of the image size: the channels are
+# processed in place (measured 7-12x, the FFT buffers of large bg_size dominate for small images), while
+# debug mode keeps the intermediate images for the plots
+MEMFACTOR = 12
+MEMFACTOR_DEBUG = 32
+
+# cache of the background kernels, per padded shape and radius (see get_background_kernel)
+BG_KERNELS = {}
+
+# cache of the flat-field profiles, per file (see load_flatfield)
+FLATFIELDS = {}
+
+# scratch buffers of the background computation, per padded shape (see get_scratch_buffers)
+BG_BUFFERS = {}
+
+# memory available for the histograms of the median background, in bytes (see get_background_median)
+BG_MEDIAN_MAXBYTES = 2**28
+
 #################### function ####################
 def default_parameters():
     """Generate a default parameter dictionary."""
@@ -39,6 +58,11 @@ def default_parameters():
     mydict['invert'] = None
     mydict['bg_subtract'] = True
     mydict['bg_size'] = 400
+    mydict['bg_decimation'] = 1
+    mydict['bg_method'] = 'logmean_fft'
+    mydict['bg_stride'] = 16
+    mydict['flatfield'] = {'file': None, 'nsample': 32, 'percentile': 50., 'smooth': 50., 'dark': 0.}
+    mydict['tiff_options'] = {'compression': None, 'level': None, 'predictor': True, 'tile': None, 'maxworkers': None}
 
     return params
 
@@ -172,7 +196,199 @@ def get_background_medianblur(img, size=201):
 
     return bg
 
-def get_background_logmean_fft(img, size=201, logtransform=False):
+def get_window_sums(integral, i0, i1, j0, j1):
+    """
+    Return the sums over the windows [i0:i1, j0:j1] of the first two axes of an array, from its integral
+    (cumulative sums along the first two axes, with a leading row and column of zeros).
+    """
+    return integral[i1,j1] - integral[i0,j1] - integral[i1,j0] + integral[i0,j0]
+
+def get_tile_histograms(tiles, values, ntiles, nbins=256):
+    """
+    Return the integral of the histograms of the values in each tile (see get_window_sums).
+    INPUT:
+      * tiles: (ny, nx) tile index of each value, in increasing order of the rows of tiles.
+      * values: integer values between 0 and nbins-1.
+    OUTPUT:
+      * int32 array with shape (ny+1, nx+1, nbins).
+    NOTE:
+      * The histograms are computed one row of tiles at a time, so that only the integral is allocated in full.
+    """
+    ny, nx = ntiles
+    integral = np.zeros((ny+1, nx+1, nbins), dtype=np.int32)
+    bounds = np.searchsorted(tiles // nx, np.arange(ny+1))
+    for i in range(ny):
+        s = slice(bounds[i], bounds[i+1])
+        hist = np.bincount((tiles[s] - i*nx)*nbins + values[s], minlength=nx*nbins).reshape((nx, nbins))
+        np.cumsum(hist, axis=0, out=integral[i+1,1:])
+        integral[i+1] += integral[i]
+    return integral
+
+def get_window_medians(img, stride, ntiles, i0, i1, j0, j1):
+    """
+    Return the lower medians of img over windows of tiles (see get_background_median).
+    INPUT:
+      * img: 2D image of unsigned integers (up to 16 bits), divided in stride x stride tiles.
+      * ntiles: (ny, nx) number of tiles of img.
+      * i0, i1, j0, j1: (nrows, 1) and (1, nx) first and last (excluded) tiles of the windows along each axis.
+    OUTPUT:
+      * (nrows, nx) array of medians.
+    """
+    h,w = img.shape
+    ny, nx = ntiles
+    nrows = i0.shape[0]
+    yy = np.arange(h) // stride
+    xx = np.arange(w) // stride
+    tiles = np.ravel(yy[:,None]*nx + xx[None,:])
+    iy = np.arange(nrows)[:,None]
+    ix = np.arange(nx)[None,:]
+
+    # high byte of the median
+    values = np.ravel(img).astype(np.int32)
+    high = values >> 8
+    integral = get_tile_histograms(tiles, high, (ny,nx))
+    hist = get_window_sums(integral, i0, i1, j0, j1)
+    del integral
+    cum = np.cumsum(hist, axis=2, dtype=np.int32)
+    rank = (cum[:,:,-1]-1) // 2
+    med_high = np.argmax(cum > rank[:,:,None], axis=2)
+    below = cum[iy,ix,med_high] - hist[iy,ix,med_high]
+    rank -= below
+    del hist, cum
+
+    # low byte of the median
+    low = values & 255
+    del values
+    med_low = np.zeros((nrows,nx), dtype=np.int_)
+    for b in np.unique(med_high):
+        select = (high == b)
+        integral = get_tile_histograms(tiles[select], low[select], (ny,nx))
+        wy, wx = np.nonzero(med_high == b)
+        hist = get_window_sums(integral, i0[wy,0], i1[wy,0], j0[0,wx], j1[0,wx])
+        del integral
+        cum = np.cumsum(hist, axis=1, dtype=np.int32)
+        med_low[wy,wx] = np.argmax(cum > rank[wy,wx][:,None], axis=1)
+        del hist, cum
+
+    return med_high*256 + med_low
+
+def get_median_band_nbytes(nrows, k, ntiles, stride, width, nbins=256):
+    """
+    Return an estimate of the memory in bytes used by get_background_median to compute a band of nrows rows of
+    tiles, with windows of half width k tiles, for an image with ntiles = (ny, nx) tiles and width pixels per row.
+    """
+    ny, nx = ntiles
+    nin = min(nrows + 2*k, ny)
+    return (nin+1)*(nx+1)*nbins*4 + 3*nrows*nx*nbins*4 + nin*stride*width*40
+
+def get_background_median(img, size=201, stride=16, maxbytes=BG_MEDIAN_MAXBYTES):
+    """
+    Compute the background of an image as the median over a sliding square window of width size.
+    The median is computed exactly, in full precision, on a grid with spacing stride and interpolated bilinearly
+    in between.
+    INPUT:
+      * img: 2D image of unsigned integers (up to 16 bits).
+      * size: width of the window, rounded to an odd multiple of stride.
+      * stride: spacing of the grid in pixels.
+      * maxbytes: memory available for the histograms, in bytes.
+    NOTE:
+      * The image is divided in stride x stride tiles, and the median of each window is computed from the
+        histograms of the tiles that it covers: the histograms of the high bytes of the pixel values are summed
+        over the window in constant time with an integral image, which gives the byte of the median. The low byte
+        is then found in the same way, using only the pixels whose high byte is the high byte of a median.
+        The cost does not depend on the window size.
+      * The integral images hold 256 bins per tile, so the grid is computed in bands of rows of tiles that fit
+        in maxbytes. Small strides are expensive: with stride 1, a band needs about size x width kB.
+      * Windows are truncated at the edges of the image, and the median is the lower median.
+    """
+    shape = img.shape
+    if len(shape) != 2:
+        raise ValueError("img must be a 2D array")
+    dtype = img.dtype
+    if not (np.issubdtype(dtype, np.unsignedinteger) and (dtype.itemsize <= 2)):
+        raise ValueError("The median background requires unsigned integers up to 16 bits.")
+
+    h,w = shape
+    stride = max(int(stride), 1)
+    ny = (h+stride-1) // stride
+    nx = (w+stride-1) // stride
+    k = max(int(round(0.5*(size/float(stride) - 1.))), 0)     # half width of the window in tiles
+
+    # largest band of rows of tiles that fits in memory
+    nrows = ny
+    while (nrows > 1) and (get_median_band_nbytes(nrows, k, (ny,nx), stride, w) > maxbytes):
+        nrows = (nrows+1) // 2
+    nbytes = get_median_band_nbytes(nrows, k, (ny,nx), stride, w)
+    if (nbytes > maxbytes):
+        raise ValueError("The median background of size {:d} with stride {:d} needs {:.0f} MB for an image of shape {}, more than {:.0f} MB: increase bg_stride.".format(size, stride, nbytes/2.**20, shape, maxbytes/2.**20))
+
+    # windows of each tile
+    ix = np.arange(nx)
+    j0 = np.maximum(ix-k, 0)[None,:]
+    j1 = np.minimum(ix+k+1, nx)[None,:]
+    median = np.zeros((ny,nx), dtype=np.float32)
+    for r0 in range(0, ny, nrows):
+        r1 = min(r0+nrows, ny)
+        t0 = max(r0-k, 0)
+        t1 = min(r1+k, ny)
+        iy = np.arange(r0, r1)
+        i0 = (np.maximum(iy-k, 0) - t0)[:,None]
+        i1 = (np.minimum(iy+k+1, ny) - t0)[:,None]
+        median[r0:r1] = get_window_medians(img[t0*stride:t1*stride], stride, (t1-t0,nx), i0, i1, j0, j1)
+
+    # interpolation between the centers of the tiles
+    bg = cv2.resize(median, (nx*stride, ny*stride), interpolation=cv2.INTER_LINEAR)[:h,:w]
+    bg = np.array(np.rint(bg), dtype=dtype)
+
+    return bg
+
+def get_background_kernel(shape, l):
+    """
+    Return the DFT of the footprint used to average the background: a disk of radius l, normalized to 1 and
+    centered on the origin of a periodic grid of given shape.
+    OUTPUT:
+      * float32 spectrum in the packed format of cv2.dft (real input).
+    NOTE:
+      * The kernel only depends on the padded shape and on the radius, which are the same for all FOVs of a run,
+        so it is computed once and cached in BG_KERNELS.
+    """
+    key = (tuple(shape), l)
+    if key in BG_KERNELS:
+        return BG_KERNELS[key]
+
+    hnew, wnew = shape
+    # distance to the origin on the periodic grid
+    n = np.arange(hnew)
+    n = np.minimum(n, hnew-n)
+    m = np.arange(wnew)
+    m = np.minimum(m, wnew-m)
+    F = np.array(n[:,None]**2 + m[None,:]**2 <= l**2, dtype=np.float32)
+    F /= np.sum(F)  # normalization so that it is a mean
+    Ftilde = cv2.dft(F)
+    BG_KERNELS[key] = Ftilde
+
+    return Ftilde
+
+def get_scratch_buffers(shape):
+    """
+    Return float32 buffers of given shape for the padded image and its spectrum. The buffers are allocated once
+    per shape and reused for all the images of a run, so they must not be returned to the caller.
+    """
+    key = tuple(shape)
+    if not (key in BG_BUFFERS):
+        BG_BUFFERS[key] = {'X': np.zeros(key, dtype=np.float32), 'Xtilde': np.zeros(key, dtype=np.float32)}
+    return BG_BUFFERS[key]
+
+def get_background_logmean_fft(img, size=201, logtransform=False, decimation=1):
+    """
+    Compute the background of an image as the (geometric if logtransform) mean over a disk of diameter size.
+    The image is padded by reflection to a size suitable for the FFT and the convolution is done with real
+    FFTs in single precision (cv2.dft). See get_background_kernel.
+    INPUT:
+      * decimation: if larger than 1, the (log-)image is averaged over blocks of decimation x decimation pixels,
+        the background is computed at this coarse resolution and upsampled with bilinear interpolation.
+        See get_background_errors to choose the decimation factor.
+    """
     shape = img.shape
     if len(shape) != 2:
         raise ValueError("img must be a 2D array")
@@ -189,95 +405,270 @@ def get_background_logmean_fft(img, size=201, logtransform=False):
     if (imin < 0.):
         offset = 2*np.abs(imin)
     elif (imin ==  0.):
-        offset = np.sort(np.unique(myimg))[1]
-    myimg = (myimg+offset)/scale
+        offset = np.min(myimg[myimg > 0.])  # smallest positive value
+    myimg += offset
+    myimg /= scale
 
-    # do the fft rescaling
-    h,w = myimg.shape
-    l = size//2
-    #print("l = {:d}".format(l))
-    X = np.zeros((h+2*l,w+2*l))
-    hnew,wnew = X.shape
-    F = np.zeros((hnew,wnew))
-    hrange = np.arange(hnew)
-    wrange = np.arange(wnew)
-
-    kfreq_h = np.fft.fftfreq(hnew) # frequencies
-    kfreq_w = np.fft.fftfreq(wnew) # frequencies
-
-    # pad input image by reflection
-    if (l > 0):
-        X[l:-l,l:-l] = np.copy(myimg)
-        Xpad = X[l:2*l,l:-l]
-        X[:l,l:-l] = Xpad[::-1,:]
-        Xpad = X[-2*l:-l,l:-l]
-        X[-l:,l:-l] = Xpad[::-1,:]
-
-        Xpad = X[:,l:2*l]
-        X[:,:l] = Xpad[:,::-1]
-        Xpad = X[:,-2*l:-l]
-        X[:,-l:] = Xpad[:,::-1]
-    else:
-        X = np.copy(myimg)
-
-    # make footprint for average
-    footprint_func = lambda n,m : (n**2 + m**2 <= l**2) | ((hnew-n)**2 + m**2 <= l**2) | ((hnew-n)**2 + (wnew-m)**2 <= l**2) | (n**2 + (wnew-m)**2 <= l**2)
-    hh,ww = np.meshgrid(hrange,wrange,indexing='ij')
-    F = np.float_(footprint_func(hh,ww))
-    fsum = np.sum(F)  # normalization so that it is a mean
-    F /= fsum
-    #print("fsum = {:.6f}".format(fsum))
-    # important to check than without lognorm, with l=0, it reproduces the input after fft and ifft.
-
-    Xcpy = np.copy(X)
     # log transform
     if (logtransform):
-        X = np.log(X)
+        np.log(myimg, out=myimg)
 
-    # fourier transform
-    Xtilde = np.fft.fftn(X)
-    Ftilde = np.fft.fftn(F)
-    X = np.real(np.fft.ifftn(Xtilde*Ftilde))
-    #print(np.max(X-Xcpy), np.median(X-Xcpy))
+    # coarse resolution
+    h0,w0 = myimg.shape
+    l = size//2
+    if (decimation > 1):
+        hc = max(int(round(h0/float(decimation))), 1)
+        wc = max(int(round(w0/float(decimation))), 1)
+        myimg = cv2.resize(myimg, (wc,hc), interpolation=cv2.INTER_AREA)
+        l = int(round(l/float(decimation)))
+        size = 2*l+1
+
+    # pad input image by reflection, up to a fast size for the FFT
+    # the extra padding is never seen by the pixels of the image since the footprint has radius l
+    h,w = myimg.shape
+    hnew = cv2.getOptimalDFTSize(h+2*l)
+    wnew = cv2.getOptimalDFTSize(w+2*l)
+    buffers = get_scratch_buffers((hnew,wnew))
+    X = cv2.copyMakeBorder(myimg, l, hnew-h-l, l, wnew-w-l, cv2.BORDER_REFLECT, dst=buffers['X'])
+    del myimg
+
+    # convolution with the footprint
+    Ftilde = get_background_kernel((hnew,wnew), l)
+    Xtilde = cv2.dft(X, dst=buffers['Xtilde'])
+    Xtilde = cv2.mulSpectrums(Xtilde, Ftilde, 0, c=Xtilde)
+    X = cv2.idft(Xtilde, dst=X, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
 
     # log detransform
     if (logtransform):
-        X = np.exp(X)
-    bg = X[l:-l,l:-l]
-
-#    # test
-#    import matplotlib.pyplot as plt
-#    xmin = np.min(myimg)
-#    xmax = np.max(myimg)
-#    fig=plt.figure()
-#    ax = fig.add_subplot(1,2,1)
-#    #im = ax.imshow(F)
-#    im = ax.imshow(Xcpy, vmin=xmin,vmax=xmax)
-#    fig.colorbar(im,ax=ax)
-#
-#    ax = fig.add_subplot(1,2,2)
-#    #ax.imshow(np.real(Ftilde))
-#    im = ax.imshow(X, vmin=xmin,vmax=xmax)
-#
-#    fig.colorbar(im,ax=ax)
-#
-#    fig.savefig('footprint.png')
-#    plt.close()
-#    sys.exit()
-#    # test
+        np.exp(X, out=X)
+    bg = X[l:l+h,l:l+w]
 
     # restore scaling
     bg = cv2.blur(bg,ksize=(size,size)) # maybe not essential, to smooth background values
-    #bg = np.array(bg, dtype=np.float32)/255
-    bg = scale* bg - offset
+    if (decimation > 1):
+        bg = cv2.resize(bg, (w0,h0), interpolation=cv2.INTER_LINEAR)
+    bg *= scale
+    bg -= offset
     bg = np.array(bg, dtype=img.dtype)
     return bg
 
+def get_background_errors(img, size=201, decimations=[2,4,8], logtransform=True):
+    """
+    Compare the background computed at coarse resolution to the full resolution background.
+    INPUT:
+      * img: 2D image.
+      * decimations: decimation factors to test (see get_background_logmean_fft).
+    OUTPUT:
+      * list of dictionaries, one per decimation factor (including 1 for the reference), with the computation
+        time in s and the errors relative to the reference background: maximum, mean and 99th percentile
+        of |bg - bg_ref| / bg_ref, and mean absolute error in grey levels.
+    """
+    report = []
+    bg_ref = None
+    for decimation in [1] + [d for d in decimations if d != 1]:
+        t0 = time.time()
+        bg = get_background_logmean_fft(img, size=size, logtransform=logtransform, decimation=decimation)
+        runtime = time.time() - t0
+        if bg_ref is None:
+            bg_ref = np.array(bg, dtype=np.float_)
+            ref = np.maximum(bg_ref, 1.)
+        err = np.abs(np.array(bg, dtype=np.float_) - bg_ref)
+        rel = err / ref
+        report.append({'decimation': decimation, 'time': runtime, 'error_max': float(np.max(rel)), \
+                'error_mean': float(np.mean(rel)), 'error_p99': float(np.percentile(rel, 99)), 'error_abs_mean': float(np.mean(err))})
+
+    return report
+
+
+def get_flatfield_bins(tiff_file, lo, width, invert=None, nbins=16):
+    """
+    Return the bin of each pixel of each channel in the per-pixel histograms used to estimate the flat-field:
+    bin n holds the values in [lo + n*width, lo + (n+1)*width), and the values outside of the nbins bins get
+    the bin nbins, which is not counted (see add_flatfield_bins).
+    INPUT:
+      * lo: (nchannels, height, width) lower edge of the first bin of each pixel.
+      * invert: channels to invert, as in preprocess_image.
+    OUTPUT:
+      * uint8 array with shape (nchannels, height, width).
+    """
+    img = get_tiff2ndarray(tiff_file, channel=None, normalize=False)
+    if (img.ndim == 2):
+        img = img[np.newaxis]
+    nchannel = img.shape[0]
+    norm = get_img_norm(img.dtype)
+    if invert is None:
+        invert = []
+    elif invert == 'all':
+        invert = range(nchannel)
+    if (lo.shape != img.shape):
+        raise ValueError("Shape of the image {} different from the shape of the flat-field sample {}".format(img.shape, lo.shape))
 
-def preprocess_image(tiff_file, outputdir='.', invert=None, bg_subtract=True, bg_size=200, debug=False):
+    bins = np.zeros(img.shape, dtype=np.uint8)
+    for c in range(nchannel):
+        arr = np.array(img[c], dtype=np.int64)
+        if c in invert:
+            arr = int(norm) - arr
+        arr -= lo[c]
+        arr //= width
+        arr[arr < 0] = nbins
+        np.minimum(arr, nbins, out=arr)
+        bins[c] = arr
+
+    return bins
+
+def add_flatfield_bins(counts, bins, nbins=16):
+    """
+    Count the bins of the pixels of one image (see get_flatfield_bins) in the per-pixel histograms.
+    INPUT:
+      * counts: int32 array with shape (nbins, nchannels, height, width), or None to allocate it.
+    OUTPUT:
+      * counts.
+    """
+    if counts is None:
+        counts = np.zeros((nbins,)+bins.shape, dtype=np.int32)
+    flat = np.ravel(bins)
+    pixels = np.flatnonzero(flat < nbins)
+    # each pixel has a single bin, so the flat indices are unique
+    counts.reshape(-1)[np.int_(flat[pixels])*flat.size + pixels] += 1
+    return counts
+
+def estimate_flatfield(tiff_files, invert=None, nsample=32, percentile=50., smooth=50., dark=0., njobs=1):
+    """
+    Estimate the flat-field of the experiment from a sample of FOVs.
+    INPUT:
+      * tiff_files: images of the experiment. nsample of them, evenly spaced, are used.
+      * invert: channels to invert, as in preprocess_image.
+      * percentile: the per-pixel background is this percentile of the values of the pixel over the FOVs, which
+        rejects the cells as long as they cover a pixel in less than (100 - percentile) % of the FOVs.
+      * smooth: standard deviation in px of the Gaussian smoothing of the background.
+      * dark: dark level (camera offset), as a number or one per channel.
+    OUTPUT:
+      * dictionary with the background (nchannels, height, width), the flat-field normalized to a mean of 1,
+        and the dark level of each channel.
+    NOTE:
+      * The percentile is computed exactly, in a few passes over the FOVs: each pass counts the values of each
+        pixel in a coarse histogram of nbins bins (see get_flatfield_bins), and the next pass refines the bin that
+        contains the percentile. The workers only return the bin of each pixel, and a single int32 histogram of
+        nbins x the number of pixels is kept, so that the memory used does not depend on the number of FOVs.
+    """
+    if not (0. <= percentile <= 100.):
+        raise ValueError("percentile must be between 0 and 100.")
+    idx = np.unique(np.int_(np.rint(np.linspace(0, len(tiff_files)-1, min(nsample, len(tiff_files))))))
+    sample = [tiff_files[i] for i in idx]
+    nsample = len(sample)
+    if (nsample < 3):
+        raise ValueError("At least 3 FOVs are needed to estimate the flat-field.")
+    if (nsample > 2**16-1):
+        raise ValueError("At most {:d} FOVs can be sampled to estimate the flat-field.".format(2**16-1))
+    print "{:<20s}{:<d}".format("nsample", nsample)
+
+    img = get_tiff2ndarray(sample[0], channel=None, normalize=False)
+    if (img.ndim == 2):
+        img = img[np.newaxis]
+    shape = img.shape
+    nvalues = int(get_img_norm(img.dtype)) + 1
+    # the workers hold the image, the lower edges of the bins and the image in int64 for one channel
+    mem_per_job = img.nbytes + (8 if (nvalues > 2**31) else 4)*img.size + 8*img[0].size
+    del img
+
+    # rank of the percentile (lower value)
+    rank = int(np.floor(percentile/100.*(nsample-1)))
+    nbins = 16
+    width = nvalues
+    lo = np.zeros(shape, dtype=(np.int64 if (nvalues > 2**31) else np.int32))
+    below = np.zeros(shape, dtype=np.int32)    # number of values below lo
+    add_bins = lambda counts, bins: add_flatfield_bins(counts, bins, nbins=nbins)
+    while (width > 1):
+        width = (width+nbins-1) // nbins
+        counts = sum_jobs(get_flatfield_bins, [([f, lo, width], dict(invert=invert, nbins=nbins)) for f in sample], njobs=njobs, mem_per_job=mem_per_job, add=add_bins)
+        cum = np.cumsum(counts, axis=0, dtype=np.int32)
+        del counts
+        cum += below
+        b = np.argmax(cum > rank, axis=0)
+        below = np.where(b > 0, np.take_along_axis(cum, np.maximum(b-1, 0)[np.newaxis], axis=0)[0], below)
+        del cum
+        lo += np.array(b*width, dtype=lo.dtype)
+        print "{:<20s}{:<d}".format("bin width", width)
+    value = lo
+
+    nchannel = shape[0]
+    dark = np.array(dark, dtype=np.float_) * np.ones(nchannel)
+    background = np.zeros(shape, dtype=np.float32)
+    flat = np.zeros(shape, dtype=np.float32)
+    for c in range(nchannel):
+        bg = np.array(value[c], dtype=np.float32)
+        if smooth > 0.:
+            bg = cv2.GaussianBlur(bg, (0,0), sigmaX=smooth, borderType=cv2.BORDER_REFLECT)
+        background[c] = bg
+        ff = np.maximum(bg - dark[c], 0.)
+        ffmean = np.mean(ff)
+        if not (ffmean > 0.):
+            raise ValueError("Background of channel {:d} not above the dark level {:g}: cannot estimate the flat-field.".format(c, dark[c]))
+        ff /= ffmean
+        flat[c] = np.maximum(ff, 1.0e-3)
+
+    profile = {}
+    profile['background'] = background
+    profile['flat'] = flat
+    profile['dark'] = dark
+    profile['files'] = np.array([get_image_name(f) for f in sample], dtype=np.string_)
+
+    return profile
+
+def write_flatfield(fileout, profile):
+    """
+    Write the flat-field profile returned by estimate_flatfield.
+    """
+    np.savez_compressed(fileout, **profile)
+    return
+
+def load_flatfield(pathtoflat):
+    """
+    Load a flat-field profile. Profiles are cached, so that each worker reads the file once.
+    """
+    key = os.path.realpath(pathtoflat)
+    if not (key in FLATFIELDS):
+        if not os.path.isfile(pathtoflat):
+            raise ValueError("Flat-field missing at {:s}. Run preprocess_images.py with --flatfield first.".format(pathtoflat))
+        with np.load(pathtoflat) as data:
+            FLATFIELDS[key] = {k: data[k] for k in data.files}
+    return FLATFIELDS[key]
+
+def apply_flatfield(arr, profile, channel):
+    """
+    Correct one channel with the flat-field profile: (arr - dark) / flat - level, where the background level
+    of the image is the median of the flat-field corrected image.
+    OUTPUT:
+      * background (dark + level * flat) and corrected image, with the type of arr.
+    """
+    flat = profile['flat'][channel]
+    dark = profile['dark'][channel]
+    if (flat.shape != arr.shape):
+        raise ValueError("Shape of the flat-field {} different from the shape of the image {}".format(flat.shape, arr.shape))
+    norm = get_img_norm(arr.dtype)
+
+    corrected = np.array(arr, dtype=np.float32)
+    corrected -= dark
+    corrected /= flat
+    level = np.median(corrected)
+    corrected -= level
+    np.clip(corrected, 0., norm, out=corrected)
+    bg = np.clip(dark + level*flat, 0., norm)
+
+    return np.array(np.rint(bg), dtype=arr.dtype), np.array(np.rint(corrected), dtype=arr.dtype)
+
+def preprocess_image(tiff_file, outputdir='.', invert=None, bg_subtract=True, bg_size=200, bg_decimation=1, bg_method='logmean_fft', bg_stride=16, flatfield=None, debug=False, tiff_options=None):
     """
     INPUT:
       * file to a tiff image.
+      * bg_method: 'logmean_fft' for the geometric mean over a disk (see get_background_logmean_fft), 'median' for
+        the median over a square window (see get_background_median) or 'flatfield' for the flat-field correction
+        of the experiment (see apply_flatfield).
+      * bg_decimation: decimation factor used to compute the background at coarse resolution (1 for full resolution),
+        for the 'logmean_fft' method.
+      * bg_stride: spacing of the grid on which the median is computed, for the 'median' method.
+      * flatfield: parameters of the flat-field. The profile is read from flatfield['file'], or from
+        'flatfield.npz' in the output directory, for the 'flatfield' method.
     OUTPUT:
       * file with a preprocessed tiff image.
 
@@ -298,10 +689,23 @@ def preprocess_image(tiff_file, outputdir='.', invert=None, bg_subtract=True, bg
     # method for background subtraction
     #get_background = get_background_medianblur
     #get_background = get_background_checkerboard
-    get_background = lambda arr, size: get_background_logmean_fft(arr, size=size, logtransform=True)
+    if bg_method == 'logmean_fft':
+        get_background = lambda arr, size: get_background_logmean_fft(arr, size=size, logtransform=True, decimation=bg_decimation)
+    elif bg_method == 'median':
+        get_background = lambda arr, size: get_background_median(arr, size=size, stride=bg_stride)
+    elif bg_method == 'flatfield':
+        pathtoflat = None
+        if not (flatfield is None):
+            pathtoflat = flatfield.get('file', None)
+        if pathtoflat is None:
+            pathtoflat = os.path.join(outputdir, 'flatfield.npz')
+        profile = load_flatfield(pathtoflat)
+        get_background = lambda arr, size: get_background_logmean_fft(arr, size=size, logtransform=True)    # debug only
+    else:
+        raise ValueError("Background method not implemented.")
 
     # pre-processing
-    bname = os.path.splitext(os.path.basename(tiff_file))[0]
+    bname = os.path.splitext(get_image_name(tiff_file))[0]
 
     # read the input tiff_file
     img, meta = get_tiff2ndarray(tiff_file, channel=None,metadata=True,normalize=False) # read all channels
@@ -330,57 +734,61 @@ def preprocess_image(tiff_file, outputdir='.', invert=None, bg_subtract=True, bg
     bg_size = 2*int(bg_size/2) + 1 # make odd
     print "bg_size = {:d}".format(bg_size)
 
-    img0 = np.copy(img)
-    # process channels
-    img_bg = np.zeros(shape, dtype=dtype)
-    img_subtracted = np.copy(img0)
-    blur = np.zeros((nchannel, height, width), dtype=dtype)
+    # intermediate images, only kept for the debug plots
+    if debug:
+        img0 = np.copy(img)
+        img_bg = np.zeros(img.shape, dtype=dtype)
+        img_subtracted = np.zeros(img.shape, dtype=dtype)
+        blur = np.zeros(img.shape, dtype=dtype)
+
+    # process channels in place
+    scale=5
     for c in range(nchannel):
         # select source
         arr = img[c]
 
         # invert if needed
         if c in invert:
-            arr = np.array(norm - arr, dtype=dtype)
-            img0[c]=np.copy(arr)
+            np.subtract(np.array(norm, dtype=dtype), arr, out=arr)
+            if debug:
+                img0[c] = arr
 
         # background subtraction
         if bg_subtract:
-#            print "Background subtraction..."
-            # method for background subtraction using sliding window
-            img_bg[c] = get_background(arr, bg_size)
-            idx = arr > img_bg[c]
-#            print np.unique(arr)
-#            print np.unique(img_bg[c])
-#            print ""
-            arr[idx] = arr[idx] - img_bg[c][idx]
-            arr[~idx] = 0
-            img_subtracted[c] = np.copy(arr)
-        else:
-            img_subtracted[c] = np.zeros((height,width), dtype=dtype)
+            if bg_method == 'flatfield':
+                bg, arr[:] = apply_flatfield(arr, profile, c)
+            else:
+                # method for background subtraction using sliding window
+                bg = get_background(arr, bg_size)
+            if debug:
+                img_bg[c] = bg
+            if bg_method != 'flatfield':
+                # arr - bg where arr > bg, 0 elsewhere
+                np.minimum(bg, arr, out=bg)
+                np.subtract(arr, bg, out=arr)
+            del bg
+            if debug:
+                img_subtracted[c] = arr
 
         # preprocess the imaging for connected components finding
         ## gaussian blur
-        scale=5
-        arr = cv2.GaussianBlur(arr,(scale,scale),sigmaX=0,sigmaY=0)
-        blur[c] = np.copy(arr)
-
-        # save
-        img[c]=arr
+        cv2.GaussianBlur(arr,(scale,scale),sigmaX=0,sigmaY=0,dst=arr)
+        if debug:
+            blur[c] = arr
 
     # write tiff
     dirname = os.path.dirname(tiff_file)
     if dirname == outputdir:
         raise ValueError("Output dir must be different from TIFF dir: {}".format(dirname))
-    fname = os.path.basename(tiff_file)
+    fname = get_image_name(tiff_file)
     fileout = os.path.join(outputdir,fname)
-    ti.imwrite(fileout, img, imagej=True, photometric='minisblack', metadata=meta)
+    write_tiff(fileout, img, metadata=meta, tiff_options=tiff_options)
     print "{:<20s}{:<s}".format('fileout',fileout)
 
     # debug
     if debug:
         print "Debug for preprocess images"
-        img_bg_post = np.zeros(shape, dtype=dtype)
+        img_bg_post = np.zeros(img.shape, dtype=dtype)
         for c in range(nchannel):
 #            print "c = {:d}".format(c)
             img_bg_post[c] = get_background(img[c], bg_size)
@@ -436,6 +844,9 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--paramfile',  type=file, required=False, help='Yaml file containing parameters.')
     parser.add_argument('-d', '--outputdir',  type=str, required=False, help='Output directory')
     parser.add_argument('--debug',  action='store_true', required=False, help='Enable debug mode')
+    parser.add_argument('-j', '--jobs',  type=int, required=False, default=1, help='Number of worker processes (0 for as many as CPUs, capped by the available memory).')
+    parser.add_argument('--flatfield',  action='store_true', required=False, help='Estimate the flat-field of the experiment from the images and write it in flatfield.npz, instead of preprocessing the images.')
+    parser.add_argument('--bg-report',  type=int, nargs='*', required=False, help='Compare the background computed with the given decimation factors (default 2 4 8) to the full resolution background, instead of preprocessing the images.')
 
     # INITIALIZATION
     # load arguments
@@ -471,7 +882,7 @@ if __name__ == "__main__":
     tiff_files = []
     if namespace.images is None:
         namespace.images=[]
-    for f in namespace.images:
+    for f in expand_image_files(namespace.images):
         test = check_tiff_file(f)
         if test:
             tiff_files.append(f)
@@ -479,21 +890,67 @@ if __name__ == "__main__":
     if ntiffs == 0:
         raise ValueError("No tiff detected!")
 
-    # copy metadata
+    # copy metadata and table of FOVs
     tiffdir=os.path.dirname(os.path.relpath(tiff_files[0], rootdir))
-    metadata=os.path.join(tiffdir,'metadata.txt')
-    if os.path.isfile(metadata):
-        dest = os.path.join(outputdir,os.path.basename(metadata))
-        if (os.path.realpath(metadata) != os.path.realpath(dest)):
-            shutil.copy(metadata,dest)
+    for metadata in [os.path.join(tiffdir,'metadata.txt'), os.path.join(tiffdir,'fovs.txt')]:
+        if os.path.isfile(metadata):
+            dest = os.path.join(outputdir,os.path.basename(metadata))
+            if (os.path.realpath(metadata) != os.path.realpath(dest)):
+                shutil.copy(metadata,dest)
 
     # debug or not
     if namespace.debug:
         print "!! Debug mode !!"
 
     params=allparams['preprocess_images']
-
-    for f in tiff_files:
-        pf=preprocess_image(f, outputdir=outputdir, debug=namespace.debug, **params)
-        pf = os.path.relpath(pf,rootdir)
+    check_tiff_options(params.get('tiff_options', None))
+
+    # FLAT-FIELD ESTIMATION
+    if namespace.flatfield:
+        ffparams = dict(default_parameters()['preprocess_images']['flatfield'])
+        ffparams.update(params.get('flatfield', None) or {})
+        pathtoflat = ffparams.pop('file')
+        if pathtoflat is None:
+            pathtoflat = os.path.join(outputdir, 'flatfield.npz')
+        profile = estimate_flatfield(tiff_files, invert=params.get('invert', None), njobs=namespace.jobs, **ffparams)
+        write_flatfield(pathtoflat, profile)
+        for c in range(len(profile['flat'])):
+            print "channel {:d}: background {:.1f} - {:.1f}, flat-field {:.3f} - {:.3f}".format(c, np.min(profile['background'][c]), np.max(profile['background'][c]), np.min(profile['flat'][c]), np.max(profile['flat'][c]))
+        print "{:<20s}{:<s}".format("fileout", pathtoflat)
+        sys.exit(0)
+
+    # BACKGROUND ERROR REPORT
+    if not (namespace.bg_report is None):
+        decimations = namespace.bg_report
+        if len(decimations) == 0:
+            decimations = [2,4,8]
+        bg_size = 2*int(params['bg_size']/2) + 1
+        invert = params.get('invert', None)
+        if invert is None:
+            invert = []
+        report = {'bg_size': bg_size, 'files': {}}
+        print "{:<30s}{:>4s}{:>6s}{:>10s}{:>12s}{:>12s}{:>12s}".format("file", "c", "dec", "time (s)", "err. max", "err. mean", "err. p99")
+        for f in tiff_files:
+            img = get_tiff2ndarray(f, channel=None, normalize=False)
+            if (img.ndim == 2):
+                img = np.array([img], dtype=img.dtype)
+            norm = get_img_norm(img.dtype)
+            fname = get_image_name(f)
+            report['files'][fname] = []
+            for c in range(img.shape[0]):
+                arr = img[c]
+                if (invert == 'all') or (c in invert):
+                    arr = np.array(norm - arr, dtype=img.dtype)
+                res = get_background_errors(arr, size=bg_size, decimations=decimations, logtransform=True)
+                for x in res:
+                    print "{:<30s}{:>4d}{:>6d}{:>10.3f}{:>12.2e}{:>12.2e}{:>12.2e}".format(fname, c, x['decimation'], x['time'], x['error_max'], x['error_mean'], x['error_p99'])
+                report['files'][fname].append(res)
+        fileout = os.path.join(outputdir, 'bg_report.txt')
+        write_dict2json(fileout, report)
+        print "{:<20s}{:<s}".format("fileout", fileout)
+        sys.exit(0)
+
+    jobs = [([f], dict(outputdir=outputdir, debug=namespace.debug, **params)) for f in tiff_files]
+    mem_per_job = (MEMFACTOR_DEBUG if namespace.debug else MEMFACTOR)*get_tiff_nbytes(tiff_files[0])
+    run_jobs(preprocess_image, jobs, njobs=namespace.jobs, mem_per_job=mem_per_job)
 
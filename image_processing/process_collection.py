@@ -48,10 +48,50 @@ def default_parameters():
 
     return params
 
+def process_collection_columns(data, new_attributes, mpp=None):
+    """
+    Add new attributes to a columnar cell collection, as in the loop over the cells of the JSON collection,
+    with whole columns at once.
+    INPUT:
+      * data: dictionary of columns (see load_collection_columns).
+      * new_attributes: 'volume' (in cubic pixels) and/or 'volume_um' (in cubic micrometers).
+      * mpp: size of a pixel in micrometers. If None, the 'mpp' column is used.
+    OUTPUT:
+      * dictionary of columns of the processed cells.
+    """
+    ncells = len(data['id'])
+    new = {}
+    select = np.ones(ncells, dtype=np.bool_)
+    if 'volume' in new_attributes:
+        # in cubic pixels
+        w = np.asarray(data['width'], dtype=np.float_)
+        h = np.asarray(data['height'], dtype=np.float_)
+        new['volume'] = np.pi/4.* w**2*h - np.pi/12.*w**3 # cylinder with hemispherical caps of length h and width w
+
+    # conversion to cubic micrometers
+    if 'volume_um' in new_attributes:
+        volume = new.get('volume', data.get('volume', None))
+        if mpp is None:
+            mpp = data.get('mpp', None)
+        if mpp is None:
+            print "Unit is lacking: mpp = 1! Skipping cells."
+            select[:] = False
+        elif volume is None:
+            print 'Volume must be computed for \'volume_um\''
+            select[:] = False
+        else:
+            mpp = np.asarray(mpp, dtype=np.float_)
+            new['volume_um'] = np.asarray(volume, dtype=np.float_)*mpp*mpp*mpp
+
+    cells = {}
+    for col in set(data.keys()) | set(new.keys()):
+        cells[col] = np.asarray(new[col] if (col in new) else data[col])[select]
+    return cells
+
 #################### main ####################
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="Processing tool -- Collection of cells.")
-    parser.add_argument('cellfile',  type=str, help='Path to a cell dictionary in json format.')
+    parser.add_argument('cellfile',  type=str, help='Path to a cell collection (dictionary in json format or columns directory).')
     parser.add_argument('-f', '--paramfile',  type=file, required=False, help='Yaml file containing parameters.')
     parser.add_argument('-d', '--outputdir',  type=str, required=False, help='Output directory')
     parser.add_argument('--debug',  action='store_true', required=False, help='Enable debug mode')
@@ -62,11 +102,16 @@ if __name__ == "__main__":
 
     # input cell file
     cellfile = os.path.realpath(namespace.cellfile)
-    if not os.path.isfile(cellfile):
+    if not os.path.exists(cellfile):
         raise ValueError("Cell file does not exist! {:<s}".format(cellfile))
 
-    cells = load_json2dict(cellfile)
-    ncells = len(cells)
+    if os.path.isdir(cellfile):
+        # columnar collection: the columns are memory-mapped and processed as arrays
+        cells = load_collection_columns(cellfile, mmap=True)
+        ncells = len(cells['id'])
+    else:
+        cells = load_collection(cellfile)
+        ncells = len(cells)
     print "ncells = {:d}".format(ncells)
 
     # output directory
@@ -98,6 +143,16 @@ if __name__ == "__main__":
     params = allparams['process_collection']
     new_attributes = params['new_attributes']
     mpp = params['mpp']
+    bname = os.path.splitext(os.path.basename(cellfile))[0]
+    fname = "{}_processed".format(bname)
+    if os.path.isdir(cellfile):
+        cells_new = process_collection_columns(cells, new_attributes, mpp=mpp)
+        pathtocells = os.path.join(outputdir, fname)
+        write_collection_arrays(pathtocells, cells_new)
+        print "ncells_new = {:d}".format(len(cells_new['id']))
+        print "{:<20s}{:<s}".format('fileout', pathtocells)
+        sys.exit(0)
+
     keys = cells.keys()
     keys_sel = []
     for n in range(ncells):
@@ -138,8 +193,6 @@ if __name__ == "__main__":
     print "ncells_new = {:d}".format(ncells_new)
 
     cells_new = make_dict_serializable(cells_new)
-    bname = os.path.splitext(os.path.basename(cellfile))[0]
-    fname = "{}_processed".format(bname)
     pathtocells = os.path.join(outputdir, fname + '.js')
     write_dict2json(pathtocells,cells_new)
     print "{:<20s}{:<s}".format('fileout', pathtocells)
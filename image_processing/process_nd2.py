@@ -40,6 +40,10 @@ def default_parameters():
     mydict['xcrop'] = None
     #mydict['ycrop'] = [0,7]
     mydict['ycrop'] = None
+    # 'tiff' (one file per FOV) or 'hdf5' (single chunked array store)
+    mydict['output_format'] = 'tiff'
+    mydict['store'] = {'compression': 'gzip', 'compression_opts': 4, 'chunk_size': 256}
+    mydict['tiff_options'] = {'compression': None, 'level': None, 'predictor': True, 'tile': None, 'maxworkers': None}
 
     return params
 
@@ -50,6 +54,8 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--paramfile',  type=file, required=False, help='Yaml file containing parameters.')
     parser.add_argument('-d', '--outputdir',  type=str, required=False, help='Output directory')
     parser.add_argument('--debug',  action='store_true', required=False, help='Enable debug mode')
+    parser.add_argument('--resume',  action='store_true', required=False, help='Only export the FOVs that are missing or stale in the manifest of a previous export.')
+    parser.add_argument('-j', '--jobs',  type=int, required=False, default=1, help='Number of worker processes exporting FOVs (0 for as many as CPUs, capped by the available memory).')
 
     # load arguments
     namespace = parser.parse_args(sys.argv[1:])
@@ -83,7 +89,9 @@ if __name__ == "__main__":
     # load ND2 file
     ## load images
     params=allparams['process_nd2']
-    metainfo = acq.process_nd2_tiff(namespace.ND2, tiffdir=outputdir, **params)
+    if params.get('output_format', 'tiff') != 'hdf5':
+        check_tiff_options(params.get('tiff_options', None))
+    metainfo = acq.process_nd2_tiff(namespace.ND2, tiffdir=outputdir, njobs=namespace.jobs, resume=namespace.resume, **params)
     ## print metadata
     fileout = os.path.join(outputdir, "metadata.txt")
     metainfo = make_dict_serializable(metainfo)
@@ -14,6 +14,8 @@ import cPickle as pkl
 
 # custom
 from utils import *
+import componentslib as cpl
+import geometrylib as geo
 
 #################### global params ####################
 # yaml formats
@@ -26,6 +28,9 @@ yaml.add_representer(np.float_,npfloat_representer)
 yaml.add_representer(np.ndarray,nparray_representer)
 yaml.add_representer(unicode,unicode_representer)
 
+# rough upper bound of the memory used to segment one FOV, in units of the image size
+MEMFACTOR = 16
+
 #################### function ####################
 def default_parameters():
     """Generate a default parameter dictionary."""
@@ -41,6 +46,8 @@ def default_parameters():
             }
     mydict['channel'] = 0
     mydict['mask_params']={'threshold': 0.95}
+    mydict['fused_outputs'] = ['labels']
+    mydict['file_format'] = 'compact'
 
     return params
 
@@ -129,7 +136,57 @@ def get_background_img(img, size=65):
 #    # end j loop
     return bg
 
-def get_estimator_boundingbox(tiff_file, channel=0, outputdir='.', w0=1, w1=100, h0=10, h1=1000, acut=0.9, aratio_min=2., aratio_max=100., border_pad=5, emin=1.0e-4, debug=False, threshold=None):
+def get_scores_boundingbox(widths, heights, areas, boxes_upright, shape, w0=1, w1=100, h0=10, h1=1000, acut=0.9, aratio_min=2., aratio_max=100., border_pad=5, emin=1.0e-4):
+    """
+    Compute the bounding box scores of all connected components at once.
+    INPUT:
+      * widths, heights: dimensions of the rotated bounding boxes (in any order).
+      * areas: number of pixels in each component.
+      * boxes_upright: upright bounding boxes (x,y,w,h) of each component.
+      * shape: (height, width) of the image.
+      * other parameters: see get_estimator_boundingbox.
+    OUTPUT:
+      * array of scores between 0 and 1, one per component.
+    """
+    height,width = shape
+
+    # get bounding box width and height
+    w = np.minimum(widths, heights)
+    h = np.maximum(widths, heights)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        area_rect = w*h
+        aval = areas/area_rect
+        aratio = h/w
+
+        # computing score
+        scores = np.ones(len(w), dtype=np.float_)
+        scores *= np.minimum(1,np.exp((w-w0)))              # penalize w < w0
+        scores *= np.minimum(1,np.exp(w1-w))                # penalize w > w1
+        scores *= np.minimum(1,np.exp((h-h0)))              # penalize w < w0
+        scores *= np.minimum(1,np.exp(h1-h))                # penalize w > w1
+        scores *= np.minimum(1,np.exp(aval-acut))           # penalize area/rect < acut
+        scores *= np.minimum(1,np.exp(aratio-aratio_min))   # penalize aratio < aratio_min
+        scores *= np.minimum(1,np.exp(aratio_max-aratio))   # penalize aratio > aratio_max
+
+    # degenerate boxes (single pixel or line)
+    scores[w == 0.] = 0.
+
+    # check that box corners of an upright bounding box are within the image plus some pad
+    x,y,ww,hh = np.transpose(np.reshape(boxes_upright, (-1,4)))
+    x0 = x-border_pad
+    y0 = y-border_pad
+    x1 = x + ww + border_pad
+    y1 = y + hh + border_pad
+    idx = (x0 >= 0) & (x1 < width) & (y0 >= 0) & (y1 < height)
+    scores[~idx] = 0.
+
+    # discard small values
+    scores[scores < emin] = 0.
+
+    return scores
+
+def make_estimator_boundingbox(tiff_file, channel=0, outputdir='.', w0=1, w1=100, h0=10, h1=1000, acut=0.9, aratio_min=2., aratio_max=100., border_pad=5, emin=1.0e-4, debug=False, threshold=None):
     """
     INPUT:
       * file to a tiff image.
@@ -138,7 +195,9 @@ def get_estimator_boundingbox(tiff_file, channel=0, outputdir='.', w0=1, w1=100,
       * acut: minimum area/rectangle bounding box ratio.
       * threshold is a lower threshold (everything below is set to zero). Value must be a float between 0 and 1. 1 is the maximum, eg. 255 or 65535.
     OUTPUT:
-      * 2D matrix of weights corresponding to the probability that a pixel belongs to a cell.
+      * matrix of connected components and table of scores. The estimator is the 2D matrix scores[components] of weights
+        corresponding to the probability that a pixel belongs to a cell.
+        The output directory is only used for debug plots.
 
     USEFUL DOCUMENTATION:
       * https://docs.opencv.org/3.4.3/dd/d49/tutorial_py_contour_features.html
@@ -198,98 +257,32 @@ def get_estimator_boundingbox(tiff_file, channel=0, outputdir='.', w0=1, w1=100,
     img_morph = np.copy(img)
 
     ## find connected components
-    ncomp, labels = cv2.connectedComponents(img)
+    ncomp, labels, areas, slices = cpl.get_components(img)
     print "Found {:d} objects".format(ncomp)
 
     ## compute the bounding box for the identified labels
     #for n in range(ncomp):
     height,width = img.shape
-    Y,X = np.mgrid[0:height,0:width]
     boundingboxes=[]
     boundingboxes_upright=[]
-    pointsperbox=[]
     for n in np.arange(ncomp):
-        idx = (labels == n)
-        # pixels coordinates for the label
-        points = np.transpose([X[idx],Y[idx]])
-        pointsperbox.append(len(points))
-
-        # upright rectangles
-        bb = cv2.boundingRect(points)
-        boundingboxes_upright.append(bb)
-
-        # rotated rectangles
-        bb = cv2.minAreaRect(points)
+        # rotated and upright rectangles from the outer contour of the label
+        bb, bb_upright = geo.get_label_boxes(labels, n, slices[n])
         boundingboxes.append(bb)
+        boundingboxes_upright.append(bb_upright)
 
     # estimator matrix
     ## compute scores
-    scores = []
-    for n in np.arange(ncomp):
-        bb = boundingboxes[n]
-        bb_upright = boundingboxes_upright[n]
-        area = pointsperbox[n]
-
-        # get bounding box width and height
-        xymid,wh,angle=bb
-        w,h=wh
-        if w > h:
-            wtp=w
-            w=h
-            h=wtp
+    wh = np.array([bb[1] for bb in boundingboxes], dtype=np.float_).reshape(-1,2)
+    scores = get_scores_boundingbox(wh[:,0], wh[:,1], areas, boundingboxes_upright, img.shape, w0=w0, w1=w1, h0=h0, h1=h1, acut=acut, aratio_min=aratio_min, aratio_max=aratio_max, border_pad=border_pad, emin=emin)
 
-        area_rect = w*h
-        aval = area/area_rect
-        aratio = h/w
-#        print "w={:.1f}    h={:.1f}  aval={:.2e}  aratio={:.1f}".format(w,h,aval,aratio)
-
-        # computing score
-        score = 1.
-        score *= min(1,np.exp((w-w0)))              # penalize w < w0
-        score *= min(1,np.exp(w1-w))                # penalize w > w1
-        score *= min(1,np.exp((h-h0)))              # penalize w < w0
-        score *= min(1,np.exp(h1-h))                # penalize w > w1
-        score *= min(1,np.exp(aval-acut))           # penalize area/rect < acut
-        score *= min(1,np.exp(aratio-aratio_min))   # penalize aratio < aratio_min
-        score *= min(1,np.exp(aratio_max-aratio))   # penalize aratio > aratio_max
-
-        # check that box corners of an upright bounding box are within the image plus some pad
-        x,y,ww,hh = bb_upright
-        x0 = x-border_pad
-        y0 = y-border_pad
-        x1 = x + ww + border_pad
-        y1 = y + hh + border_pad
-#        print "a0 = {:d}  b0 = {:d}".format(x,y)
-#        print "a1 = {:d}  b1 = {:d}".format(x+ww,y+hh)
-#        print "x0 = {:d}  y0 = {:d}".format(x0,y0)
-#        print "x1 = {:d}  y1 = {:d}".format(x1,y1)
-        if not (x0 >= 0 and x1 < width and y0 >=0 and y1 < height):
-            score = 0.
-
-        # discard small values
-        if score < emin:
-            score = 0.
-        scores.append(score)
-
-    # estimator matrix
-    eimg = np.zeros(img.shape, dtype=np.float_)
-    for n in np.arange(ncomp):
-        idx = (labels == n)
-        eimg[idx] = scores[n]
-    nz = np.sum(eimg > 0.)
-    ntot = len(np.ravel(eimg))
+    # the estimator matrix is scores[labels]
+    nz = np.sum(areas[scores > 0.])
+    ntot = labels.size
     print "nz = {:d} / {:d}    sparcity index = {:.2e}".format(nz, ntot, float(nz)/float(ntot))
-    efname = bname
-    #efile = os.path.join(outputdir,efname+'.txt')
-    #efile = os.path.join(outputdir,efname+'.pkl')
-    efile = os.path.join(outputdir,efname+'.npz')
-    with open(efile,'w') as fout:
-        #np.savetxt(fout, eimg)
-        #pkl.dump(eimg,fout)
-        ssp.save_npz(efile, ssp.coo_matrix(eimg), compressed=False)
-    print "{:<20s}{:<s}".format('est. file', efile)
 
     if debug:
+        eimg = scores[labels]
         debugdir = os.path.join(outputdir,'debug')
         if not os.path.isdir(debugdir):
             os.makedirs(debugdir)
@@ -399,9 +392,37 @@ def get_estimator_boundingbox(tiff_file, channel=0, outputdir='.', w0=1, w1=100,
     # canny: start """
 
 
+    return labels, scores
+
+def get_estimator_boundingbox(tiff_file, outputdir='.', file_format='compact', **kwargs):
+    """
+    Compute the estimator with the bounding box method and write it in the output directory.
+    See make_estimator_boundingbox for the arguments.
+    OUTPUT:
+      * path to the estimator file.
+    """
+    bname = os.path.splitext(os.path.basename(tiff_file))[0]
+    components, scores = make_estimator_boundingbox(tiff_file, outputdir=outputdir, **kwargs)
+
+    efile = os.path.join(outputdir,bname+'.npz')
+    write_estimator(efile, components=components, scores=scores, file_format=file_format)
+
     return os.path.realpath(efile)
 
-def get_estimator(tiff_file, method='bounding_box', outputdir='.', channel=0, estimator_params=dict(w0=1, w1=100, l0=10, l1=1000, acut=0.9, aratio_min=2., aratio_max=100.), emin=1.0e-4, debug=False):
+def make_estimator(tiff_file, method='bounding_box', outputdir='.', channel=0, estimator_params=dict(w0=1, w1=100, l0=10, l1=1000, acut=0.9, aratio_min=2., aratio_max=100.), emin=1.0e-4, debug=False):
+    """
+    Compute the estimator for a given images. The estimator is returned as a matrix of connected components and a table of scores for those components.
+    The outputdir is only used for debug plots.
+    """
+    # perform the segmentation
+    if method == 'bounding_box':
+        components, scores = make_estimator_boundingbox(tiff_file, channel=channel, outputdir=outputdir, debug=debug, emin=emin, **estimator_params)
+    else:
+        raise ValueError("Segmentation method not implemented.")
+
+    return components, scores
+
+def get_estimator(tiff_file, method='bounding_box', outputdir='.', channel=0, estimator_params=dict(w0=1, w1=100, l0=10, l1=1000, acut=0.9, aratio_min=2., aratio_max=100.), emin=1.0e-4, debug=False, file_format='compact'):
     """
     Compute the estimator for a given images. The estimator is a real matrix where each entry is the estimation that the corresponding pixel belongs to the segmented class.
     INPUT:
@@ -409,15 +430,28 @@ def get_estimator(tiff_file, method='bounding_box', outputdir='.', channel=0, es
     OUTPUT:
         * path to a matrix (written in a file) of same size of the orignal image.
     """
-    # perform the segmentation
-    if method == 'bounding_box':
-        efile = get_estimator_boundingbox(tiff_file, channel=channel, outputdir=outputdir, debug=debug, emin=emin, **estimator_params)
-    else:
-        raise ValueError("Segmentation method not implemented.")
+    bname = os.path.splitext(os.path.basename(tiff_file))[0]
+    components, scores = make_estimator(tiff_file, method=method, outputdir=outputdir, channel=channel, estimator_params=estimator_params, emin=emin, debug=debug)
+
+    efile = os.path.join(outputdir,bname+'.npz')
+    write_estimator(efile, components=components, scores=scores, file_format=file_format)
 
-    return efile
+    return os.path.realpath(efile)
 
-def get_mask(f, ef, threshold=0., outputdir='.', debug=False):
+def make_mask(emat, threshold=0.):
+    """
+    Make a binary mask by applying a threshold to an estimator matrix.
+    """
+    return np.array(emat > threshold, dtype=np.uint8)
+
+def make_label(mask):
+    """
+    Make a matrix containing labels for each connected component of a binary mask.
+    """
+    n, labels = cv2.connectedComponents(mask)
+    return labels
+
+def get_mask(f, ef, threshold=0., outputdir='.', debug=False, file_format='compact'):
     """
     Make a binary mask by applying a threshold to the input estimator file.
     INPUT:
@@ -426,100 +460,164 @@ def get_mask(f, ef, threshold=0., outputdir='.', debug=False):
         * mf: binary mask
     """
     bname = os.path.splitext(os.path.basename(f))[0]
-    # read and convert input to dense matrix
-    with open(ef, 'r') as fin:
-        emat = ssp.load_npz(fin).todense()
+    # read input as a dense matrix
+    emat = load_estimator(ef)
 
     # apply threshold
-    mask = np.array(emat > threshold, dtype=np.uint8)
+    mask = make_mask(emat, threshold=threshold)
 
     # write the mask
     mfname = bname
     #mfile = os.path.join(outputdir,mfname+'.txt')
     #mfile = os.path.join(outputdir,mfname+'.pkl')
     mfile = os.path.join(outputdir,mfname+'.npz')
-    with open(mfile,'w') as fout:
-        #np.savetxt(fout, mask)
-        #pkl.dump(mask,fout)
-        ssp.save_npz(mfile, ssp.coo_matrix(mask), compressed=False)
-    print "{:<20s}{:<s}".format('mask file', mfile)
+    write_mask(mfile, mask, file_format=file_format, threshold=threshold)
 
     # debug
     if debug:
-        debugdir = os.path.join(outputdir,'debug')
-        if not os.path.isdir(debugdir):
-            os.makedirs(debugdir)
-        # plots
-        import matplotlib.pyplot as plt
-        height, width = mask.shape
-        ratio = float(height)/width
-        fig = plt.figure(num=None,figsize=(4,4*ratio))
-        ax=fig.gca()
-        ax.imshow(mask,cmap='gray')
-        ax.set_xticks([]), ax.set_yticks([])
-        ax.set_title('MASK')
-        fname = "{}_mask_debug".format(bname)
-        fileout = os.path.join(debugdir,fname + '.png')
-        fig.tight_layout()
-        plt.savefig(fileout,dpi=300, bbox_inches='tight', pad_inches=0)
-        print "{:<20s}{:<s}".format('debug file', fileout)
-        plt.close('all')
+        plot_mask_debug(mask, bname, outputdir=outputdir)
 
     return os.path.realpath(mfile)
 
-def get_label(f, mf, outputdir='.', debug=False):
+def plot_mask_debug(mask, bname, outputdir='.'):
+    """
+    Plot a binary mask in the debug directory.
+    """
+    debugdir = os.path.join(outputdir,'debug')
+    if not os.path.isdir(debugdir):
+        os.makedirs(debugdir)
+    # plots
+    import matplotlib.pyplot as plt
+    height, width = mask.shape
+    ratio = float(height)/width
+    fig = plt.figure(num=None,figsize=(4,4*ratio))
+    ax=fig.gca()
+    ax.imshow(mask,cmap='gray')
+    ax.set_xticks([]), ax.set_yticks([])
+    ax.set_title('MASK')
+    fname = "{}_mask_debug".format(bname)
+    fileout = os.path.join(debugdir,fname + '.png')
+    fig.tight_layout()
+    plt.savefig(fileout,dpi=300, bbox_inches='tight', pad_inches=0)
+    print "{:<20s}{:<s}".format('debug file', fileout)
+    plt.close('all')
+
+    return
+
+def get_label(f, mf, ef=None, threshold=None, outputdir='.', debug=False, file_format='compact'):
     """
     Make a matrix containing labels for each connected component.
     INPUT:
         * binary mask
+        * (optional) estimator file and mask threshold. If the estimator file contains its connected components
+          and the mask was made with the same threshold, the labels are obtained by relabeling the components that
+          pass the threshold, without finding the connected components of the mask again. Otherwise the labels
+          are the connected components of the mask.
     OUTPUT:
         * label matrix
     """
     bname = os.path.splitext(os.path.basename(f))[0]
-    # read and convert input to dense matrix
-    with open(mf, 'r') as fin:
-        mmat = ssp.load_npz(fin).todense()
-
-    # find connected components
-    n, labels = cv2.connectedComponents(mmat)
+    components = None
+    if not (ef is None or threshold is None):
+        mask_threshold = load_mask_threshold(mf)
+        if (mask_threshold is None) or (mask_threshold != float(threshold)):
+            print "Mask {} not made with threshold {}: labeling the mask".format(mf, threshold)
+        else:
+            components, scores = load_estimator_components(ef)
+
+    if components is None:
+        # read input as a dense matrix
+        mmat = load_mask(mf)
+
+        # find connected components
+        labels = make_label(mmat)
+        component_ids = None
+    else:
+        labels, component_ids = cpl.relabel_components(components, scores, threshold=threshold)
 
     # write the labels
     lfname = bname
     #lfile = os.path.join(outputdir,lfname+'.txt')
     #lfile = os.path.join(outputdir,lfname+'.pkl')
     lfile = os.path.join(outputdir,lfname+'.npz')
-    with open(lfile,'w') as fout:
-        #np.savetxt(fout, labels)
-        #pkl.dump(labels,fout)
-        ssp.save_npz(lfile, ssp.coo_matrix(labels), compressed=False)
-    print "{:<20s}{:<s}".format('labels file', lfile)
+    write_labels(lfile, labels, file_format=file_format, component_ids=component_ids)
 
     # debug
     if debug:
-        debugdir = os.path.join(outputdir,'debug')
-        if not os.path.isdir(debugdir):
-            os.makedirs(debugdir)
-        ncolors=20-1
-        labels_mod = np.uint8(labels - np.int_(labels / ncolors) * ncolors) + 1 # between 1 and 19
-        # plots
-        import matplotlib.pyplot as plt
-        height, width = labels.shape
-        ratio = float(height)/width
-        fig = plt.figure(num=None,figsize=(4,4*ratio))
-        ax=fig.gca()
-        ax.imshow(labels_mod,cmap='tab20c')
-        ax.set_xticks([]), ax.set_yticks([])
-        ax.set_title('LABELS')
-        fname = "{}_labels_debug".format(bname)
-        fileout = os.path.join(debugdir,fname + '.png')
-        fig.tight_layout()
-        plt.savefig(fileout,dpi=300, bbox_inches='tight', pad_inches=0)
-        print "{:<20s}{:<s}".format('debug file', fileout)
-        plt.close('all')
-
+        plot_labels_debug(labels, bname, outputdir=outputdir)
 
     return os.path.realpath(lfile)
 
+def plot_labels_debug(labels, bname, outputdir='.'):
+    """
+    Plot a label matrix in the debug directory.
+    """
+    debugdir = os.path.join(outputdir,'debug')
+    if not os.path.isdir(debugdir):
+        os.makedirs(debugdir)
+    ncolors=20-1
+    labels_mod = np.uint8(labels - np.int_(labels / ncolors) * ncolors) + 1 # between 1 and 19
+    # plots
+    import matplotlib.pyplot as plt
+    height, width = labels.shape
+    ratio = float(height)/width
+    fig = plt.figure(num=None,figsize=(4,4*ratio))
+    ax=fig.gca()
+    ax.imshow(labels_mod,cmap='tab20c')
+    ax.set_xticks([]), ax.set_yticks([])
+    ax.set_title('LABELS')
+    fname = "{}_labels_debug".format(bname)
+    fileout = os.path.join(debugdir,fname + '.png')
+    fig.tight_layout()
+    plt.savefig(fileout,dpi=300, bbox_inches='tight', pad_inches=0)
+    print "{:<20s}{:<s}".format('debug file', fileout)
+    plt.close('all')
+
+    return
+
+def get_segmentation_fused(tiff_file, method='bounding_box', channel=0, estimator_params=dict(w0=1, w1=100, l0=10, l1=1000, acut=0.9, aratio_min=2., aratio_max=100.), mask_params={'threshold': 0.95}, estimator_dir='.', mask_dir='.', label_dir='.', outputs=['labels'], debug=False, file_format='compact'):
+    """
+    Compute the estimator, the mask and the labels of a given image in memory, without intermediate files.
+    INPUT:
+        * path to a tiff image.
+        * outputs: artifacts to write among 'estimators', 'masks' and 'labels'. The labels are always written.
+        * file_format: format of the written artifacts (see utils.write_segmentation_file).
+    OUTPUT:
+        * paths to the estimator, mask and label files. None is returned for artifacts that were not written.
+    """
+    bname = os.path.splitext(os.path.basename(tiff_file))[0]
+    efile = None
+    mfile = None
+    lfile = None
+
+    # estimator
+    components, scores = make_estimator(tiff_file, method=method, outputdir=estimator_dir, channel=channel, estimator_params=estimator_params, debug=debug)
+    if 'estimators' in outputs:
+        efile = os.path.join(estimator_dir,bname+'.npz')
+        write_estimator(efile, components=components, scores=scores, file_format=file_format)
+        efile = os.path.realpath(efile)
+
+    # mask
+    if ('masks' in outputs) or debug:
+        mask = make_mask(scores[components], **mask_params)
+        if 'masks' in outputs:
+            mfile = os.path.join(mask_dir,bname+'.npz')
+            write_mask(mfile, mask, file_format=file_format, threshold=mask_params.get('threshold', None))
+            mfile = os.path.realpath(mfile)
+        if debug:
+            plot_mask_debug(mask, bname, outputdir=mask_dir)
+        del mask
+
+    # labels (relabeling of the components passing the threshold)
+    labels, component_ids = cpl.relabel_components(components, scores, **mask_params)
+    lfile = os.path.join(label_dir,bname+'.npz')
+    write_labels(lfile, labels, file_format=file_format, component_ids=component_ids)
+    lfile = os.path.realpath(lfile)
+    if debug:
+        plot_labels_debug(labels, bname, outputdir=label_dir)
+
+    return efile, mfile, lfile
+
 #################### main ####################
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="Segmentation tool -- cells.")
@@ -527,6 +625,8 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--paramfile',  type=file, required=False, help='Yaml file containing parameters.')
     parser.add_argument('-d', '--outputdir',  type=str, required=False, help='Output directory')
     parser.add_argument('--debug',  action='store_true', required=False, help='Enable debug mode')
+    parser.add_argument('-j', '--jobs',  type=int, required=False, default=1, help='Number of worker processes (0 for as many as CPUs, capped by the available memory).')
+    parser.add_argument('--fused',  action='store_true', required=False, help='Compute estimators, masks and labels in memory for each file. Only the artifacts listed in \'fused_outputs\' are written.')
 
     # INITIALIZATION
     # load arguments
@@ -575,6 +675,8 @@ if __name__ == "__main__":
 
     params=allparams['segmentation']
     segmentation_method=params['method']
+    file_format=params.get('file_format', 'compact')
+    print "{:<20s}{:<s}".format("file format", file_format)
 
     # BUILD INDEX IF NECESSARY
     pathtoindex = os.path.join(outputdir,"index_tiffs.txt")
@@ -606,6 +708,36 @@ if __name__ == "__main__":
     dest = os.path.join(rootdir,os.path.basename(metadata))
     if (os.path.realpath(metadata) != os.path.realpath(dest)):
         shutil.copy(metadata,dest)
+    fovtable=os.path.join(tiffdir,'fovs.txt')
+    dest = os.path.join(rootdir,os.path.basename(fovtable))
+    if os.path.isfile(fovtable) and (os.path.realpath(fovtable) != os.path.realpath(dest)):
+        shutil.copy(fovtable,dest)
+
+    # memory estimate for one file
+    mem_per_job = MEMFACTOR*get_tiff_nbytes(tiff_files[0])
+
+    # FUSED SEGMENTATION
+    index = load_index(pathtoindex)
+    index = np.array(index,dtype=np.string_)
+    if namespace.fused and (index.shape[1] < 2):
+        outputs = params.get('fused_outputs', ['labels'])
+        print "{:<20s}{:<s}".format("fused outputs", ", ".join(outputs))
+        estimator_dir=os.path.join(outputdir,'estimators')
+        mask_dir=os.path.join(outputdir,'masks')
+        label_dir=os.path.join(outputdir,'labels')
+        for key,d in zip(['estimators','masks','labels'],[estimator_dir, mask_dir, label_dir]):
+            if ((key in outputs) or (key == 'labels')) and not os.path.isdir(d):
+                os.makedirs(d)
+        kwargs = dict(method=segmentation_method, channel=params['channel'], estimator_params=params['estimator_params'][segmentation_method], mask_params=params['mask_params'], estimator_dir=estimator_dir, mask_dir=mask_dir, label_dir=label_dir, outputs=outputs, debug=namespace.debug, file_format=file_format)
+        results = run_jobs(get_segmentation_fused, [([f], kwargs) for f in tiff_files], njobs=namespace.jobs, mem_per_job=mem_per_job)
+        seg_files = []
+        for files in results:
+            seg_files.append([('None' if x is None else os.path.relpath(x,outputdir)) for x in files])
+        seg_files = np.array(seg_files, dtype=np.string_)
+        index = np.concatenate([index,seg_files], axis=1)
+
+        write_index(pathtoindex,index)
+        print "{:<20s}{:<s}".format("fileout", pathtoindex)
 
     # BUILD ESTIMATOR MATRICES
     build_estimator=False
@@ -618,9 +750,10 @@ if __name__ == "__main__":
         if not os.path.isdir(estimator_dir):
             os.makedirs(estimator_dir)
         print "{:<20s}{:<s}".format("est. dir.", estimator_dir)
+        kwargs = dict(method=segmentation_method, outputdir=estimator_dir, estimator_params=params['estimator_params'][segmentation_method], channel=params['channel'], debug=namespace.debug, file_format=file_format)
+        results = run_jobs(get_estimator, [([f], kwargs) for f in tiff_files], njobs=namespace.jobs, mem_per_job=mem_per_job)
         est_files = []
-        for f in tiff_files:
-            ef=get_estimator(f, method=segmentation_method, outputdir=estimator_dir, estimator_params=params['estimator_params'][segmentation_method], channel=params['channel'], debug=namespace.debug)
+        for ef in results:
             est_files.append(os.path.relpath(ef,outputdir))
         est_files = np.array(est_files, dtype=np.string_)
         index = np.concatenate([index,np.transpose([est_files])], axis=1)
@@ -639,13 +772,16 @@ if __name__ == "__main__":
         if not os.path.isdir(mask_dir):
             os.makedirs(mask_dir)
         print "{:<20s}{:<s}".format("mask dir.", mask_dir)
-        mask_files = []
+        jobs = []
         nfile = len(index)
         for n in range(nfile):
             f, ef = index[n]
             f = os.path.join(outputdir,f)
             ef = os.path.join(outputdir,ef)
-            mf=get_mask(f, ef, outputdir=mask_dir, debug=namespace.debug, **params['mask_params'])
+            jobs.append(([f, ef], dict(outputdir=mask_dir, debug=namespace.debug, file_format=file_format, **params['mask_params'])))
+        results = run_jobs(get_mask, jobs, njobs=namespace.jobs, mem_per_job=mem_per_job)
+        mask_files = []
+        for mf in results:
             mask_files.append(os.path.relpath(mf,outputdir))
 
         mask_files = np.array(mask_files, dtype=np.string_)
@@ -665,14 +801,17 @@ if __name__ == "__main__":
         if not os.path.isdir(label_dir):
             os.makedirs(label_dir)
         print "{:<20s}{:<s}".format("label dir.", label_dir)
-        label_files = []
+        jobs = []
         nfile = len(index)
         for n in range(nfile):
             f, ef, mf = index[n]
             f = os.path.join(outputdir,f)
             ef = os.path.join(outputdir,ef)
             mf = os.path.join(outputdir,mf)
-            lf=get_label(f, mf, outputdir=label_dir, debug=namespace.debug)
+            jobs.append(([f, mf], dict(ef=ef, threshold=params['mask_params']['threshold'], outputdir=label_dir, debug=namespace.debug, file_format=file_format)))
+        results = run_jobs(get_label, jobs, njobs=namespace.jobs, mem_per_job=mem_per_job)
+        label_files = []
+        for lf in results:
             label_files.append(os.path.relpath(lf,outputdir))
 
         label_files = np.array(label_files, dtype=np.string_)
@@ -7,12 +7,40 @@ import datetime
 import argparse
 import tifffile as ti
 import cv2 as cv2
+import multiprocessing
+import inspect
+import io
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+#################### global params ####################
+# percentiles stored with the intensity histograms
+HIST_PERCENTILES = [0.1, 1., 5., 25., 50., 75., 95., 99., 99.9]
+
+# names of the TIFF compression codecs in the legacy tifffile API (compress argument)
+TIFF_CODECS_LEGACY = {'zlib': 'ADOBE_DEFLATE', 'deflate': 'ADOBE_DEFLATE', 'zstd': 'ZSTD', 'lzma': 'LZMA', 'lzw': 'LZW'}
+
+# TIFF writing options already checked (see check_tiff_options)
+TIFF_OPTIONS_CHECKED = {}
+
+# separator in references to images of an array store: 'store.h5::fov' or 'store.h5::fov::t'
+STORE_SEP = '::'
 
 def check_tiff_file(tiff_file):
     """
-    Check if a tiff file is valid.
+    Check if a tiff file (or a reference to an image in an array store) is valid.
     """
     test=True
+    # image in an array store
+    if is_store_ref(tiff_file):
+        try:
+            get_store_index(tiff_file)
+        except (ValueError, IOError, KeyError):
+            test=False
+        return test
+
     # existence of file
     if not os.path.isfile(tiff_file):
         test=False
@@ -27,11 +55,11 @@ def check_estimator_file(estimator_file):
     test=True
     # existence of file
     if not os.path.isfile(estimator_file):
-        test=False
+        return False
     # reading
     try:
-        ssp.load_npz(estimator_file)
-    except ValueError:
+        load_estimator(estimator_file)
+    except (ValueError, IOError, KeyError):
         test=False
 
     # return
@@ -44,11 +72,11 @@ def check_mask_file(mask_file):
     test=True
     # existence of file
     if not os.path.isfile(mask_file):
-        test=False
+        return False
     # reading
     try:
-        ssp.load_npz(mask_file)
-    except ValueError:
+        load_mask(mask_file)
+    except (ValueError, IOError, KeyError):
         test=False
 
     # return
@@ -61,16 +89,188 @@ def check_labels_file(labels_file):
     test=True
     # existence of file
     if not os.path.isfile(labels_file):
-        test=False
+        return False
     # reading
     try:
-        ssp.load_npz(labels_file)
-    except ValueError:
+        load_labels(labels_file)
+    except (ValueError, IOError, KeyError):
         test=False
 
     # return
     return test
 
+def get_uint_dtype(vmax):
+    """
+    Return the smallest unsigned integer type that can hold the input value.
+    """
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if vmax <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+def write_segmentation_file(fileout, artifact, mat, file_format='compact', **tables):
+    """
+    Write a segmentation artifact (estimator, mask or labels) to file.
+    INPUT:
+      * artifact: 'estimator', 'mask' or 'labels'.
+      * file_format:
+          - 'sparse': (legacy) uncompressed scipy COO matrix.
+          - 'compact': compressed npz archive with quantized uint8 scores for estimators, bit-packed masks
+            and labels stored with the smallest integer type.
+      * tables: additional arrays stored in compact archives.
+    """
+    if file_format == 'sparse':
+        ssp.save_npz(fileout, ssp.coo_matrix(mat), compressed=False)
+        return
+    elif file_format != 'compact':
+        raise ValueError("File format not implemented: {}".format(file_format))
+
+    mat = np.asarray(mat)
+    shape = np.array(mat.shape, dtype=np.int_)
+    if artifact == 'estimator':
+        # scores are between 0 and 1
+        norm8 = float(2**8-1)
+        data = np.array(np.rint(np.clip(mat,0.,1.)*norm8), dtype=np.uint8)
+        np.savez_compressed(fileout, artifact=artifact, shape=shape, norm=norm8, data=data, **tables)
+    elif artifact == 'mask':
+        data = np.packbits(np.ravel(mat) != 0)
+        np.savez_compressed(fileout, artifact=artifact, shape=shape, data=data, **tables)
+    elif artifact == 'labels':
+        data = np.array(mat, dtype=get_uint_dtype(np.max(mat) if mat.size > 0 else 0))
+        np.savez_compressed(fileout, artifact=artifact, shape=shape, data=data, **tables)
+    elif artifact == 'components':
+        # estimator stored as connected components and a table of scores, scores[components] being the estimator
+        data = np.array(mat, dtype=get_uint_dtype(np.max(mat) if mat.size > 0 else 0))
+        np.savez_compressed(fileout, artifact=artifact, shape=shape, data=data, **tables)
+    else:
+        raise ValueError("Artifact not recognized: {}".format(artifact))
+    return
+
+def load_segmentation_file(filein, artifact):
+    """
+    Read a segmentation artifact (estimator, mask or labels) written in any of the supported formats.
+    OUTPUT:
+      * plain numpy array (float for estimators, uint8 for masks, integers for labels).
+    """
+    with np.load(filein) as data:
+        if not ('artifact' in data.files):
+            # legacy sparse format
+            mat = np.asarray(ssp.load_npz(filein).todense())
+            if artifact == 'mask':
+                mat = np.array(mat, dtype=np.uint8)
+            return mat
+
+        stored = str(data['artifact'])
+        if (stored != artifact) and not (stored == 'components' and artifact == 'estimator'):
+            raise ValueError("File {} does not contain {}".format(filein, artifact))
+        shape = tuple(data['shape'])
+        if stored == 'components':
+            mat = data['scores'][data['data']]
+        elif artifact == 'estimator':
+            mat = np.array(data['data'], dtype=np.float_) / float(data['norm'])
+        elif artifact == 'mask':
+            mat = np.unpackbits(data['data'])[:int(np.prod(shape))]
+            mat = np.reshape(mat, shape)
+        elif artifact == 'labels':
+            mat = data['data']
+        else:
+            raise ValueError("Artifact not recognized: {}".format(artifact))
+    return mat
+
+def write_estimator(efile, eimg=None, file_format='compact', components=None, scores=None):
+    """
+    Write an estimator matrix to file.
+    The estimator can be given as a matrix of connected components and a table of scores, in which case
+    the compact format stores them exactly instead of the quantized estimator matrix.
+    """
+    if components is None:
+        write_segmentation_file(efile, 'estimator', eimg, file_format=file_format)
+    elif file_format == 'compact':
+        write_segmentation_file(efile, 'components', components, file_format=file_format, scores=np.asarray(scores, dtype=np.float_))
+    else:
+        write_segmentation_file(efile, 'estimator', scores[components], file_format=file_format)
+    print "{:<20s}{:<s}".format('est. file', efile)
+    return
+
+def write_mask(mfile, mask, file_format='compact', threshold=None):
+    """
+    Write a binary mask to file.
+    In the compact format, the threshold applied to the estimator can be stored as well.
+    """
+    tables = {}
+    if not (threshold is None) and (file_format == 'compact'):
+        tables['threshold'] = np.float_(threshold)
+    write_segmentation_file(mfile, 'mask', mask, file_format=file_format, **tables)
+    print "{:<20s}{:<s}".format('mask file', mfile)
+    return
+
+def write_labels(lfile, labels, file_format='compact', component_ids=None):
+    """
+    Write a label matrix to file.
+    In the compact format, the index of the estimator component of each label can be stored as well.
+    """
+    tables = {}
+    if not (component_ids is None) and (file_format == 'compact'):
+        tables['component_ids'] = np.asarray(component_ids)
+    write_segmentation_file(lfile, 'labels', labels, file_format=file_format, **tables)
+    print "{:<20s}{:<s}".format('labels file', lfile)
+    return
+
+def load_estimator(efile):
+    """
+    Read an estimator file and return it as a numpy array.
+    """
+    return load_segmentation_file(efile, 'estimator')
+
+def load_estimator_components(efile):
+    """
+    Read the connected components and the table of scores stored in an estimator file.
+    OUTPUT:
+      * components, scores. (None, None) if the file does not contain them.
+    """
+    with np.load(efile) as data:
+        if not ('artifact' in data.files) or (str(data['artifact']) != 'components'):
+            return None, None
+        components = data['data']
+        scores = data['scores']
+    return components, scores
+
+def load_label_component_ids(lfile):
+    """
+    Read the index of the estimator component of each label. Label n comes from component_ids[n-1].
+    OUTPUT:
+      * array of indices. None if the file does not contain them.
+    """
+    with np.load(lfile) as data:
+        if not ('component_ids' in data.files):
+            return None
+        component_ids = data['component_ids']
+    return component_ids
+
+def load_mask_threshold(mfile):
+    """
+    Read the threshold applied to the estimator to make a mask.
+    OUTPUT:
+      * threshold. None if the file does not contain it.
+    """
+    with np.load(mfile) as data:
+        if not ('threshold' in data.files):
+            return None
+        threshold = float(data['threshold'])
+    return threshold
+
+def load_mask(mfile):
+    """
+    Read a mask file and return it as a numpy array.
+    """
+    return load_segmentation_file(mfile, 'mask')
+
+def load_labels(lfile):
+    """
+    Read a labels file and return it as a numpy array.
+    """
+    return load_segmentation_file(lfile, 'labels')
+
 def write_index(pathtoindex,index):
     fout = open(pathtoindex,'w')
     nfile = len(index)
@@ -104,6 +304,261 @@ def load_json2dict(pathtojson):
         mydict = json.load(fin)
     return mydict
 
+def flatten_dict(mydict, prefix=''):
+    """
+    Flatten a nested dictionary. Keys of nested dictionaries are joined with a dot.
+    """
+    flat = {}
+    for k, v in mydict.items():
+        key = prefix + k
+        if isinstance(v, dict):
+            flat.update(flatten_dict(v, prefix=key+'.'))
+        else:
+            flat[key] = v
+    return flat
+
+def unflatten_dict(flat):
+    """
+    Inverse of flatten_dict.
+    """
+    mydict = {}
+    for key, v in flat.items():
+        keys = key.split('.')
+        d = mydict
+        for k in keys[:-1]:
+            d = d.setdefault(k, {})
+        d[keys[-1]] = v
+    return mydict
+
+def write_collection_columns(pathtocolumns, cells, exclude=[]):
+    """
+    Write a list of cell dictionaries in columnar format.
+    Each attribute (nested attributes are joined with a dot, eg 'fluorescence.total') is written as a typed array
+    in its own .npy file, with one row per cell. Per-channel attributes are (ncells, nchannels) matrices.
+    The list of columns is written in 'columns.js'.
+    INPUT:
+      * pathtocolumns: output directory.
+      * cells: list of cell dictionaries, all with the same attributes.
+      * exclude: top-level attributes that are not written.
+    """
+    if not os.path.isdir(pathtocolumns):
+        os.makedirs(pathtocolumns)
+
+    ncells = len(cells)
+    flats = [flatten_dict({k: v for k,v in cell.items() if not k in exclude}) for cell in cells]
+    columns = []
+    if ncells > 0:
+        columns = sorted(flats[0].keys())
+    data = {}
+    for col in columns:
+        data[col] = np.array([flat[col] for flat in flats])
+    write_collection_arrays(pathtocolumns, data, ncells=ncells)
+    return
+
+def write_collection_arrays(pathtocolumns, data, ncells=None):
+    """
+    Write a cell collection given as a dictionary of arrays with one row per cell, indexed by column name
+    (see write_collection_columns).
+    """
+    if not os.path.isdir(pathtocolumns):
+        os.makedirs(pathtocolumns)
+
+    columns = sorted(data.keys())
+    for col in columns:
+        arr = np.asarray(data[col])
+        if ncells is None:
+            ncells = len(arr)
+        elif len(arr) != ncells:
+            raise ValueError("Column {} has {:d} rows instead of {:d}".format(col, len(arr), ncells))
+        np.save(os.path.join(pathtocolumns, col+'.npy'), arr)
+
+    info = {'ncells': (0 if ncells is None else ncells), 'columns': columns}
+    write_dict2json(os.path.join(pathtocolumns, 'columns.js'), info)
+    return
+
+def load_collection_columns(pathtocolumns, columns=None, mmap=True):
+    """
+    Load columns of a cell collection written by write_collection_columns.
+    INPUT:
+      * columns: list of columns to load (all if None). A nested attribute selects all its columns, eg
+        'fluorescence' for 'fluorescence.total', 'fluorescence.background_px', etc.
+      * mmap: if True, the arrays are memory-mapped and only the parts used are read from disk.
+    OUTPUT:
+      * dictionary of arrays indexed by column name.
+    """
+    info = load_json2dict(os.path.join(pathtocolumns, 'columns.js'))
+    if columns is None:
+        columns = info['columns']
+    else:
+        selected = []
+        for name in columns:
+            matches = [col for col in info['columns'] if (col == name) or col.startswith(name+'.')]
+            if len(matches) == 0:
+                raise ValueError("Column not found in {}: {}".format(pathtocolumns, name))
+            selected += [col for col in matches if not (col in selected)]
+        columns = selected
+    mmap_mode = 'r' if mmap else None
+    data = {}
+    for col in columns:
+        data[col] = np.load(os.path.join(pathtocolumns, col+'.npy'), mmap_mode=mmap_mode)
+    return data
+
+def load_collection(pathtocells, columns=None):
+    """
+    Load a cell collection as a dictionary of cell dictionaries indexed by cell id.
+    INPUT:
+      * pathtocells: either a collection in JSON format or a directory written by write_collection_columns.
+      * columns: for a columnar collection, restrict the attributes to those columns (the id is always loaded).
+        Only these columns are read, so the readers should give the attributes that they use.
+    """
+    if not os.path.isdir(pathtocells):
+        return load_json2dict(pathtocells)
+
+    if not (columns is None) and not ('id' in columns):
+        columns = ['id'] + list(columns)
+    data = load_collection_columns(pathtocells, columns=columns, mmap=True)
+    names = data.keys()
+    ncells = len(data['id'])
+    cells = {}
+    for n in range(ncells):
+        flat = {col: data[col][n].tolist() for col in names}
+        cell = unflatten_dict(flat)
+        cells[cell['id']] = cell
+    return cells
+
+def write_collection_pixels(pathtopixels, ids, points):
+    """
+    Write the pixels of all cells as a single ragged array (CSR-style).
+    The coordinates of cell n are xcoord[offsets[n]:offsets[n+1]] and ycoord[offsets[n]:offsets[n+1]].
+    INPUT:
+      * pathtopixels: output directory.
+      * ids: list of cell ids.
+      * points: list of arrays of (x,y) points, one per cell.
+    OUTPUT:
+      * files 'id.npy', 'offsets.npy' (int64), 'xcoord.npy' and 'ycoord.npy' (packed unsigned integers), and
+        the index of the ids: 'index_id.npy' (sorted ids) and 'index_pos.npy' (int64 position of each id).
+    """
+    ids = np.array(ids, dtype=str)
+    ncells = len(ids)
+    order = np.argsort(ids, kind='mergesort')
+    sorted_ids = ids[order]
+    duplicates = np.unique(sorted_ids[1:][sorted_ids[1:] == sorted_ids[:-1]])
+    if len(duplicates) > 0:
+        raise ValueError("Duplicate cell ids in the pixel store: {}".format(", ".join(duplicates[:10])))
+    if len(points) != ncells:
+        raise ValueError("Number of cell ids ({:d}) different from the number of pixel arrays ({:d})".format(ncells, len(points)))
+
+    if not os.path.isdir(pathtopixels):
+        os.makedirs(pathtopixels)
+
+    counts = np.array([len(p) for p in points], dtype=np.int64)
+    offsets = np.zeros(ncells+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    if ncells > 0 and offsets[-1] > 0:
+        xy = np.concatenate([np.reshape(p, (-1,2)) for p in points])
+    else:
+        xy = np.zeros((0,2), dtype=np.int64)
+    vmax = np.max(xy) if len(xy) > 0 else 0
+    dtype = np.promote_types(np.uint16, get_uint_dtype(vmax))
+
+    np.save(os.path.join(pathtopixels, 'id.npy'), ids)
+    np.save(os.path.join(pathtopixels, 'index_id.npy'), sorted_ids)
+    np.save(os.path.join(pathtopixels, 'index_pos.npy'), np.array(order, dtype=np.int64))
+    np.save(os.path.join(pathtopixels, 'offsets.npy'), offsets)
+    np.save(os.path.join(pathtopixels, 'xcoord.npy'), xy[:,0].astype(dtype))
+    np.save(os.path.join(pathtopixels, 'ycoord.npy'), xy[:,1].astype(dtype))
+    return
+
+def get_cell_pixels(pathtopixels, cell_id):
+    """
+    Return the pixels of a single cell from a ragged pixel store written by write_collection_pixels.
+    The cell is found by a binary search in the sorted index of the ids, so that only a few pages of the index,
+    the offsets and the coordinates of the requested cell are read from disk.
+    INPUT:
+      * cell_id: id of the cell.
+    OUTPUT:
+      * xcoord, ycoord: arrays of pixel coordinates.
+    """
+    cell_id = str(cell_id)
+    pathtoindex = os.path.join(pathtopixels, 'index_id.npy')
+    if os.path.isfile(pathtoindex):
+        sorted_ids = np.load(pathtoindex, mmap_mode='r')
+        i = np.searchsorted(sorted_ids, cell_id)
+        if (i == len(sorted_ids)) or (sorted_ids[i] != cell_id):
+            raise ValueError("Cell not found: {}".format(cell_id))
+        n = int(np.load(os.path.join(pathtopixels, 'index_pos.npy'), mmap_mode='r')[i])
+    else:
+        # store written without an index
+        ids = np.load(os.path.join(pathtopixels, 'id.npy'), mmap_mode='r')
+        idx = np.flatnonzero(ids == cell_id)
+        if len(idx) == 0:
+            raise ValueError("Cell not found: {}".format(cell_id))
+        if len(idx) > 1:
+            raise ValueError("Duplicate cell id in the pixel store: {}".format(cell_id))
+        n = idx[0]
+    offsets = np.load(os.path.join(pathtopixels, 'offsets.npy'), mmap_mode='r')
+    start, stop = offsets[n], offsets[n+1]
+    xcoord = np.array(np.load(os.path.join(pathtopixels, 'xcoord.npy'), mmap_mode='r')[start:stop], dtype=np.int64)
+    ycoord = np.array(np.load(os.path.join(pathtopixels, 'ycoord.npy'), mmap_mode='r')[start:stop], dtype=np.int64)
+    return xcoord, ycoord
+
+def write_fov_table(pathtotable, records):
+    """
+    Write the table of FOVs in JSON format, with one list per column.
+    INPUT:
+      * records: list of dictionaries, one per image, with keys 'fov', 't', 'file', 'shape', 'x_um', 'y_um', 'z_um',
+        't_ms' and 'mpp'. Missing values are None.
+    """
+    columns = ['fov', 't', 'file', 'shape', 'x_um', 'y_um', 'z_um', 't_ms', 'mpp']
+    table = {}
+    for col in columns:
+        table[col] = [record.get(col, None) for record in records]
+    write_dict2json(pathtotable, table)
+    return
+
+def load_fov_table(pathtotable):
+    """
+    Load the table of FOVs written by write_fov_table.
+    OUTPUT:
+      * dictionary of columns. Numerical columns are numpy arrays (missing values are NaN), 'file' and 'shape' are lists.
+    """
+    table = load_json2dict(pathtotable)
+    for col in ['x_um', 'y_um', 'z_um', 't_ms', 'mpp']:
+        table[col] = np.array([(np.nan if v is None else v) for v in table[col]], dtype=np.float_)
+    for col in ['fov', 't']:
+        table[col] = np.array(table[col], dtype=np.int_)
+    return table
+
+def get_fov_index(table):
+    """
+    Return a dictionary giving the row of the FOV table for each file name.
+    """
+    return {os.path.basename(f): n for n, f in enumerate(table['file'])}
+
+def query_fovs(table, xlim=None, ylim=None, center=None, radius=None):
+    """
+    Select the rows of the FOV table from the stage positions.
+    INPUT:
+      * xlim, ylim: (min, max) ranges of the stage positions in um.
+      * center, radius: (x,y) position and distance in um.
+    OUTPUT:
+      * indices of the selected rows.
+    """
+    if not (center is None) and (radius is None):
+        raise ValueError("A radius must be given with the center.")
+    # FOVs without stage position are never selected
+    rows = np.flatnonzero(np.isfinite(table['x_um']) & np.isfinite(table['y_um']))
+    x = table['x_um'][rows]
+    y = table['y_um'][rows]
+    select = np.ones(len(rows), dtype=np.bool_)
+    if not (xlim is None):
+        select &= (x >= xlim[0]) & (x <= xlim[1])
+    if not (ylim is None):
+        select &= (y >= ylim[0]) & (y <= ylim[1])
+    if not (center is None):
+        select &= ((x-center[0])**2 + (y-center[1])**2) <= radius**2
+    return rows[select]
+
 def make_dict_serializable(mydict):
     for k, v in mydict.iteritems():
         if isinstance(v, dict):
@@ -132,13 +587,311 @@ def get_img_norm(dtype):
 
     return norm
 
-def get_tiff2ndarray(tiff_file,channel=0,metadata=False, normalize=True):
+def is_store(filein):
+    """
+    Check whether a file is an HDF5 array store.
+    """
+    return os.path.splitext(filein)[1] in ['.h5', '.hdf5']
+
+def is_store_ref(tiff_file):
+    """
+    Check whether the input refers to an image in an array store ('store.h5::fov' or 'store.h5::fov::t').
+    """
+    return (STORE_SEP in tiff_file)
+
+def parse_store_ref(ref):
+    """
+    Split a reference to an image in an array store.
+    OUTPUT:
+      * path to the store, fov and time point (None if the store has no time axis).
+    """
+    fields = ref.split(STORE_SEP)
+    if not (len(fields) in [2,3]):
+        raise ValueError("Wrong reference to an image in an array store: {}".format(ref))
+    storefile = fields[0]
+    fov = int(fields[1])
+    t = None
+    if len(fields) == 3:
+        t = int(fields[2])
+    return storefile, fov, t
+
+def get_store_refs(storefile):
+    """
+    Return the references to all the images of an array store.
+    """
+    if h5py is None:
+        raise ValueError("h5py is required to read array stores.")
+    with h5py.File(storefile, 'r') as fin:
+        frames = fin['frames']
+        fovs = frames['fov'][:]
+        tps = frames['t'][:]
+        timelapse = bool(fin['images'].attrs['timelapse'])
+    refs = []
+    for fov, t in zip(fovs, tps):
+        if timelapse:
+            refs.append(STORE_SEP.join([storefile, str(fov), str(t)]))
+        else:
+            refs.append(STORE_SEP.join([storefile, str(fov)]))
+    return refs
+
+def expand_image_files(files):
+    """
+    Replace the array stores in a list of image files by the references to all their images.
+    """
+    res = []
+    for f in files:
+        if is_store(f) and not is_store_ref(f):
+            res += get_store_refs(f)
+        else:
+            res.append(f)
+    return res
+
+def get_store_index(ref):
+    """
+    Return the index of the dataset entry and of the frame of an image in an array store.
+    OUTPUT:
+      * storefile, key (index in the 'images' dataset), frame index (in the 'frames' group).
+    """
+    if h5py is None:
+        raise ValueError("h5py is required to read array stores.")
+    storefile, fov, t = parse_store_ref(ref)
+    with h5py.File(storefile, 'r') as fin:
+        dset = fin['images']
+        fovs = list(dset.attrs['fovs'])
+        tps = list(dset.attrs['timepoints'])
+        if not (fov in fovs):
+            raise ValueError("FOV {:d} not in {}".format(fov, storefile))
+        i = fovs.index(fov)
+        if bool(dset.attrs['timelapse']):
+            if not (t in tps):
+                raise ValueError("Time point {} not in {}".format(t, storefile))
+            j = tps.index(t)
+            key = (i, j)
+            n = i*len(tps) + j
+        else:
+            key = (i,)
+            n = i
+    return storefile, key, n
+
+def get_store_image(ref, channel=None, window=None):
+    """
+    Read an image from an array store. Only the chunks covering the requested channel and window are decoded.
+    INPUT:
+      * ref: reference to the image, 'store.h5::fov' or 'store.h5::fov::t'.
+      * channel: channel to read (all if None).
+      * window: (slice_y, slice_x) sub-tile to read (full image if None).
+    OUTPUT:
+      * image, metadata of the frame.
+    """
+    storefile, key, n = get_store_index(ref)
+    if channel is None:
+        key = key + (slice(None),)
+    else:
+        key = key + (channel,)
+    if window is None:
+        window = (slice(None), slice(None))
+    key = key + tuple(window)
+    with h5py.File(storefile, 'r') as fin:
+        img = fin['images'][key]
+        meta = json.loads(fin['frames']['metadata'][n])
+    return img, meta
+
+def get_image_name(tiff_file):
+    """
+    Return the file name of an image: the base name of a tiff file, or the name of the tiff file that would have
+    been written for an image of an array store.
+    """
+    if not is_store_ref(tiff_file):
+        return os.path.basename(tiff_file)
+    storefile, key, n = get_store_index(tiff_file)
+    with h5py.File(storefile, 'r') as fin:
+        name = fin['frames']['name'][n]
+    return name + '.tif'
+
+def get_histograms(img):
+    """
+    Compute the exact intensity histogram of each channel of an integer image.
+    INPUT:
+      * img: (c,y,x) or (y,x) image with unsigned integer type.
+    OUTPUT:
+      * (nchannels, nbins) array of counts, with one bin per possible value (65536 for 16-bit images).
+    """
+    if img.ndim == 2:
+        img = img[np.newaxis]
+    nbins = int(get_img_norm(img.dtype))+1
+    hists = np.zeros((img.shape[0], nbins), dtype=np.int64)
+    for c in range(img.shape[0]):
+        hists[c] = np.bincount(np.ravel(img[c]), minlength=nbins)[:nbins]
+    return hists
+
+def get_histogram_stats(hists, percentiles=HIST_PERCENTILES):
+    """
+    Compute the minimum, maximum and percentiles of each channel from its histogram.
+    The q-th percentile is the smallest value such that a fraction q of the pixels is lower or equal.
+    OUTPUT:
+      * dictionary with 'min', 'max', 'mean', 'percentiles' (nchannels, npercentiles) and 'percentile_levels'.
+    """
+    nchannels, nbins = hists.shape
+    values = np.arange(nbins)
+    stats = {}
+    stats['min'] = np.zeros(nchannels, dtype=np.int64)
+    stats['max'] = np.zeros(nchannels, dtype=np.int64)
+    stats['mean'] = np.zeros(nchannels, dtype=np.float_)
+    stats['percentiles'] = np.zeros((nchannels, len(percentiles)), dtype=np.int64)
+    stats['percentile_levels'] = np.array(percentiles, dtype=np.float_)
+    for c in range(nchannels):
+        h = hists[c]
+        npx = np.sum(h)
+        if npx == 0:
+            continue
+        nz = np.flatnonzero(h)
+        stats['min'][c] = nz[0]
+        stats['max'][c] = nz[-1]
+        stats['mean'][c] = np.dot(h, values) / float(npx)
+        cdf = np.cumsum(h)
+        stats['percentiles'][c] = np.searchsorted(cdf, np.array(percentiles)/100.*npx, side='left')
+    return stats
+
+def get_histogram_file(tiff_file):
+    """
+    Return the path to the histogram sidecar of an image: 'histograms/<name>.npz' in the directory of the image.
+    """
+    if is_store_ref(tiff_file):
+        dirname = os.path.dirname(parse_store_ref(tiff_file)[0])
+    else:
+        dirname = os.path.dirname(tiff_file)
+    bname = os.path.splitext(get_image_name(tiff_file))[0]
+    return os.path.join(dirname, 'histograms', bname + '.npz')
+
+def write_histograms(fileout, img):
+    """
+    Write the histograms of each channel of an image, and their statistics, in a compressed npz archive.
+    """
+    dirname = os.path.dirname(fileout)
+    if (len(dirname) > 0) and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # created by another process
+            pass
+    hists = get_histograms(img)
+    stats = get_histogram_stats(hists)
+    np.savez_compressed(fileout, hists=hists, dtype=str(img.dtype), **stats)
+    return
+
+def load_histograms(filein):
+    """
+    Load the histograms of an image written by write_histograms.
+    OUTPUT:
+      * hists: (nchannels, nbins) array of counts.
+      * stats: dictionary of statistics (see get_histogram_stats).
+    """
+    with np.load(filein) as data:
+        hists = data['hists']
+        stats = {key: data[key] for key in data.files if not key in ['hists', 'dtype']}
+    return hists, stats
+
+def get_tiff_write_kwargs(compression=None, level=None, predictor=True, tile=None, maxworkers=None):
+    """
+    Translate TIFF writing options into keyword arguments for the installed version of tifffile.
+    INPUT:
+      * compression: None (uncompressed) or 'zlib'. Other codecs ('zstd', 'lzma', 'lzw') depend on the version
+        of tifffile and on imagecodecs, see check_tiff_options.
+      * level: compression level (default of the codec if None).
+      * predictor: apply horizontal differencing before compression.
+      * tile: (height, width) of the tiles, multiples of 16. Strips if None.
+      * maxworkers: number of threads used to encode the tiles (chosen by tifffile if None). Ignored by the
+        versions of tifffile that encode with a single thread.
+    """
+    func = getattr(ti.TiffWriter, 'write', None)
+    if func is None:
+        func = ti.TiffWriter.save
+    try:
+        args = inspect.getargspec(func).args
+    except (AttributeError, ValueError, TypeError):
+        args = inspect.getfullargspec(func).args
+
+    kwargs = {}
+    if not (compression in [None, 'none', 'None']):
+        compression = str(compression).lower()
+        if 'compression' in args:
+            kwargs['compression'] = compression
+            if not (level is None):
+                if 'compressionargs' in args:
+                    kwargs['compressionargs'] = {'level': level}
+                else:
+                    kwargs['compressionlevel'] = level
+        else:
+            codec = TIFF_CODECS_LEGACY.get(compression, compression.upper())
+            if (level is None) and (codec == 'ADOBE_DEFLATE'):
+                # the legacy deflate encoder requires a level
+                level = 6
+            if level is None:
+                kwargs['compress'] = codec
+            else:
+                kwargs['compress'] = (codec, level)
+        if predictor:
+            kwargs['predictor'] = True
+    if not (tile is None):
+        tile = tuple(int(x) for x in tile)
+        if any([(x % 16) != 0 for x in tile]):
+            raise ValueError("Tile dimensions must be multiples of 16: {}".format(tile))
+        kwargs['tile'] = tile
+    if not (maxworkers is None) and ('maxworkers' in args):
+        kwargs['maxworkers'] = maxworkers
+    return kwargs
+
+def check_tiff_options(tiff_options):
+    """
+    Check that the installed version of tifffile can write files with the given options, by encoding a small
+    image in memory, so that unsupported codecs are reported before any file is written.
+    """
+    if tiff_options is None:
+        tiff_options = {}
+    key = tuple(sorted((k, str(v)) for k, v in tiff_options.items()))
+    if key in TIFF_OPTIONS_CHECKED:
+        return
+    kwargs = get_tiff_write_kwargs(**tiff_options)
+    img = np.zeros((2,32,32), dtype=np.uint16)
+    try:
+        ti.imwrite(io.BytesIO(), img, imagej=True, photometric='minisblack', **kwargs)
+    except Exception as e:
+        raise ValueError("TIFF options {} not supported by the installed tifffile (version {}): {}. Use compression zlib or null, or install imagecodecs with a recent tifffile.".format(tiff_options, getattr(ti, '__version__', '?'), repr(e)))
+    TIFF_OPTIONS_CHECKED[key] = True
+    return
+
+def write_tiff(fileout, img, metadata={}, tiff_options=None):
+    """
+    Write an image in ImageJ TIFF format, with the compression and tiling given in tiff_options
+    (see get_tiff_write_kwargs).
+    """
+    if tiff_options is None:
+        tiff_options = {}
+    check_tiff_options(tiff_options)
+    kwargs = get_tiff_write_kwargs(**tiff_options)
+    ti.imwrite(fileout, img, imagej=True, photometric='minisblack', metadata=metadata, **kwargs)
+    return
+
+def get_tiff2ndarray(tiff_file,channel=0,metadata=False, normalize=True, window=None, maxworkers=None):
     """
     Open a tiff_file and return a numpy array normalized between 0 and 1.
+    The input can also be a reference to an image in an array store ('store.h5::fov' or 'store.h5::fov::t'),
+    in which case only the requested channel and window (slice_y, slice_x) are read.
+    Compressed and tiled tiff files are decoded with maxworkers threads (chosen by tifffile if None).
     """
+    if is_store_ref(tiff_file):
+        arr, meta = get_store_image(tiff_file, channel=channel, window=window)
+        if normalize:
+            norm = get_img_norm(arr.dtype)
+            arr = np.array(arr, dtype=np.float_) / norm
+        if metadata:
+            return arr, meta
+        else:
+            return arr
+
     try:
         with ti.TiffFile(tiff_file) as tif:
-            img = tif.asarray()
+            img = tif.asarray(maxworkers=maxworkers)
             meta = tif.imagej_metadata
     except Exception, e:
         print e
@@ -155,6 +908,9 @@ def get_tiff2ndarray(tiff_file,channel=0,metadata=False, normalize=True):
     else:
         raise ValueError("Hyperstacked handling not implemented.")
 
+    if not (window is None):
+        arr = arr[(Ellipsis,)+tuple(window)]
+
     if normalize:
         norm = get_img_norm(arr.dtype)
         arr = np.array(arr, dtype=np.float_) / norm
@@ -164,72 +920,68 @@ def get_tiff2ndarray(tiff_file,channel=0,metadata=False, normalize=True):
     else:
         return arr
 
-def get_OTSU(tiff_files, outputdir='.', write=True,NBYTESMAX=1000000000, nfiles=20):
+def get_file_histograms(tiff_file):
+    """
+    Return the per-channel intensity histograms of an image, from its sidecar if it is up to date.
+    """
+    hfile = get_histogram_file(tiff_file)
+    if is_store_ref(tiff_file):
+        imgfile = parse_store_ref(tiff_file)[0]
+    else:
+        imgfile = tiff_file
+    if os.path.isfile(hfile) and (os.path.getmtime(hfile) >= os.path.getmtime(imgfile)):
+        hists, stats = load_histograms(hfile)
+    else:
+        img = get_tiff2ndarray(tiff_file, channel=None, normalize=False)
+        hists = get_histograms(img)
+    return hists
+
+def get_otsu_histogram(hist):
+    """
+    Compute the Otsu threshold of a histogram exactly.
+    OUTPUT:
+      * threshold t, in units of the bins, maximizing the between-class variance of the classes
+        [0, t] and [t+1, nbins-1] (same convention as cv2.threshold).
+    """
+    hist = np.asarray(hist, dtype=np.float_)
+    values = np.arange(len(hist), dtype=np.float_)
+    npx = np.sum(hist)
+    w0 = np.cumsum(hist)
+    w1 = npx - w0
+    m0 = np.cumsum(hist*values)
+    mtot = m0[-1]
+    valid = (w0 > 0) & (w1 > 0)
+    if not np.any(valid):
+        return 0
+    # between-class variance up to a constant factor
+    sigma = np.zeros(len(hist), dtype=np.float_)
+    sigma[valid] = (mtot*w0[valid] - m0[valid]*npx)**2 / (w0[valid]*w1[valid])
+    return int(np.argmax(sigma))
+
+def get_OTSU(tiff_files, outputdir='.', write=True, njobs=1):
     """
     Read the input list of files and compute the OTSU threshold (normalized between 0 and 1).
     The result is written in the output directory.
-    NMAX is the maximum memory in bytes allowed (default to 5 Gb)
-    """
-    # get dimensions of one image and adjust cropping
-    w0=None
-    w1=None
-    h0=None
-    h1=None
-    if nfiles is None:
-        nfiles = len(tiff_files)
-    img = get_tiff2ndarray(tiff_files[0],channel=None)
-    shape = img.shape
-    if len(shape) != 3:
-        raise ValueError("Wrong format for image!")
-    nchannels, height, width = shape
-    nbytes = img.nbytes
-    nbytes_maxperimg = NBYTESMAX / nfiles
-    print "nbytes = {:,d}  nbytes_MAX = {:,d}  nbytes_MAXPERIMG = {:,d}".format(nbytes,NBYTESMAX, nbytes_maxperimg)
-    if (nbytes_maxperimg < nbytes):
-        width_new = np.int_(width*np.sqrt(float(nbytes_maxperimg)/nbytes))
-        height_new = np.int_(height*np.sqrt(float(nbytes_maxperimg)/nbytes))
-        w0 = max((width-width_new)/2,0)
-        w1 = min(w0 + width_new, width-1)
-        w0 = min(w0,width-1)
-        w1 = max(w1, 0)
-        w1 += 1
-        h0 = max((height-height_new)/2,0)
-        h1 = min(h0 + height_new, height-1)
-        h0 = min(h0,height-1)
-        h1 = max(h1, 0)
-        h1 += 1
-        print "w0 = {:d}  w1 = {:d}  h0 = {:d}  h1 = {:d}".format(w0,w1,h0,h1)
-        print "width_new / width = {:.0f} %  height_new / height = {:.0f} %".format(100.*float(width_new)/width,100.*float(height_new)/height)
-
-    # make data arrays per channels
-    data = np.array([get_tiff2ndarray(tiff_files[i],channel=None)[:,w0:w1,h0:h1] for i in range(nfiles)])
-    nfiles, nchannels, height, width = data.shape
-    data = np.moveaxis(data, source=1, destination=0)
-    data = np.reshape(data, (nchannels, nfiles*height*width))
-
-    # scale to 8-bit
-    norm8 = float(2**8-1)
-    norm16 = float(2**16-1)
-    data_min = np.zeros(nchannels)
-    data_max = np.zeros(nchannels)
-    for c in range(nchannels):
-        amin = np.nanmin(data[c])
-        amax = np.nanmax(data[c])
-        data_min[c]=amin
-        data_max[c]=amax
-        data[c] = norm8*(data[c] - amin)/(amax-amin)
-    data = np.array(data, dtype=np.uint8)
-    #print data.shape
+
+    The histograms of all the files (with one bin per possible value) are accumulated, possibly with
+    several worker processes, and the threshold is computed exactly on the merged histogram of each channel.
+    The memory used does not depend on the number of files. The histogram sidecars written during the
+    export of the images are used when available.
+    """
+    jobs = [([f], {}) for f in tiff_files]
+    hists = sum_jobs(get_file_histograms, jobs, njobs=njobs)
+    nchannels, nbins = hists.shape
+    norm = float(nbins-1)
+    print "{:<20s}{:<d}".format("nfiles", len(tiff_files))
 
     # compute threshold per channel
+    norm8 = float(2**8-1)
+    norm16 = float(2**16-1)
     thresholds = []
     for c in range(nchannels):
-        thres8, res = cv2.threshold(data[c], 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
-        amin = data_min[c]
-        amax = data_max[c]
-        thres = float(thres8)/norm8*(amax-amin) + amin
+        thres = float(get_otsu_histogram(hists[c]))/norm
         thres8 = np.uint8(thres*norm8)
-        thres16 = np.uint16(thres*norm16)
+        thres16 = np.uint16(np.rint(thres*norm16))
         thresholds.append([c, thres, thres8,thres16])
 
     thresholds = np.array(thresholds)
@@ -243,6 +995,131 @@ def get_OTSU(tiff_files, outputdir='.', write=True,NBYTESMAX=1000000000, nfiles=
     # return
     return thresholds
 
+def get_tiff_nbytes(tiff_file):
+    """
+    Return the size in bytes of the image contained in a tiff file, without reading the data.
+    """
+    if is_store_ref(tiff_file):
+        storefile, key, n = get_store_index(tiff_file)
+        with h5py.File(storefile, 'r') as fin:
+            dset = fin['images']
+            nbytes = int(np.prod(dset.shape[len(key):]))*dset.dtype.itemsize
+        return nbytes
+
+    with ti.TiffFile(tiff_file) as tif:
+        series = tif.series[0]
+        nbytes = int(np.prod(series.shape))*np.dtype(series.dtype).itemsize
+    return nbytes
+
+def get_available_memory():
+    """
+    Return the available memory in bytes, or None if it cannot be determined.
+    """
+    try:
+        with open('/proc/meminfo','r') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def get_njobs(njobs=1, mem_per_job=None):
+    """
+    Return the number of worker processes to use.
+    INPUT:
+      * njobs: requested number of workers. Values smaller than 1 mean as many as there are CPUs.
+      * mem_per_job: estimated memory used by one job in bytes. The number of workers is capped so that
+        they fit in the available memory.
+    """
+    ncpus = multiprocessing.cpu_count()
+    if (njobs is None) or (njobs < 1):
+        njobs = ncpus
+    njobs = min(njobs, ncpus)
+    mem = get_available_memory()
+    if not (mem_per_job is None) and not (mem is None):
+        njobs = min(njobs, max(1, int(mem // mem_per_job)))
+    return njobs
+
+def init_worker(nthreads=1):
+    """
+    Initialize a worker process: limit the number of threads used by OpenCV, OpenMP and BLAS
+    so that the workers do not oversubscribe the CPUs.
+    """
+    for key in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[key] = str(nthreads)
+    cv2.setNumThreads(nthreads)
+    try:
+        # threads pools of libraries already loaded
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=nthreads)
+    except ImportError:
+        pass
+    return
+
+def run_job(job):
+    """
+    Call func(*args, **kwargs) for a job (func, args, kwargs).
+    """
+    func, args, kwargs = job
+    return func(*args, **kwargs)
+
+def run_jobs(func, jobs, njobs=1, mem_per_job=None):
+    """
+    Run func(*args, **kwargs) for each (args, kwargs) in jobs, possibly in a pool of worker processes.
+    INPUT:
+      * func: function defined at the top level of a module.
+      * jobs: list of (args, kwargs).
+      * njobs: number of worker processes (see get_njobs). With one worker, the jobs are run in the current process.
+      * mem_per_job: estimated memory used by one job in bytes.
+    OUTPUT:
+      * list of results, in the same order as the jobs whatever the completion order.
+    """
+    njobs = min(get_njobs(njobs, mem_per_job=mem_per_job), len(jobs))
+    if njobs <= 1:
+        return [func(*args, **kwargs) for args, kwargs in jobs]
+
+    print "{:<20s}{:<d}".format("njobs", njobs)
+    pool = multiprocessing.Pool(processes=njobs, initializer=init_worker)
+    try:
+        results = pool.map(run_job, [(func, args, kwargs) for args, kwargs in jobs], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def sum_jobs(func, jobs, njobs=1, mem_per_job=None, add=None):
+    """
+    Sum the results of func(*args, **kwargs) for each (args, kwargs) in jobs, possibly in a pool of worker processes.
+    The results are added as they arrive, so that the memory used does not depend on the number of jobs.
+    INPUT:
+      * mem_per_job: estimated memory used by one job in bytes (see get_njobs).
+      * add: function add(total, res) returning the new total, with total None for the first result.
+        By default, total + res.
+    """
+    if add is None:
+        add = lambda total, res: res if (total is None) else total + res
+    njobs = min(get_njobs(njobs, mem_per_job=mem_per_job), len(jobs))
+    if njobs <= 1:
+        total = None
+        for args, kwargs in jobs:
+            total = add(total, func(*args, **kwargs))
+        return total
+
+    print "{:<20s}{:<d}".format("njobs", njobs)
+    pool = multiprocessing.Pool(processes=njobs, initializer=init_worker)
+    total = None
+    try:
+        for res in pool.imap_unordered(run_job, [(func, args, kwargs) for args, kwargs in jobs]):
+            total = add(total, res)
+    finally:
+        pool.close()
+        pool.join()
+    return total
+
 #################### main ####################
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="Utility tools.")
@@ -250,6 +1127,7 @@ if __name__ == "__main__":
     parser.add_argument('-i', '--images',  type=str, nargs='+', required=False, help='tiff files to open.', default=[])
     parser.add_argument('--otsu',  action='store_true', required=False, help='Compute the OTSU thresholds for each channel.')
     parser.add_argument('-d', '--outputdir',  type=str, required=False, help='Output directory')
+    parser.add_argument('-j', '--jobs',  type=int, required=False, default=1, help='Number of worker processes (0 for as many as CPUs).')
 
     # INITIALIZATION
     # load arguments
@@ -282,7 +1160,7 @@ if __name__ == "__main__":
 #
     # check that tiff files exists
     tiff_files = []
-    for f in namespace.images:
+    for f in expand_image_files(namespace.images):
         test = check_tiff_file(f)
         if test:
             tiff_files.append(f)
@@ -292,5 +1170,5 @@ if __name__ == "__main__":
     # OTSU thresholds
     if namespace.otsu and (ntiffs > 0):
         print "Computing OTSU thresholds..."
-        thresholds = get_OTSU(tiff_files, outputdir=outputdir)
+        thresholds = get_OTSU(tiff_files, outputdir=outputdir, njobs=namespace.jobs)
 